@@ -0,0 +1,332 @@
+"""JSON API for Warbler clients, mounted at /api/v1.
+
+Endpoints select only the columns they return (no full ORM objects), encode
+with orjson when it is installed, page with the same `?before=` cursors as
+the HTML views, and carry strong ETags so clients can revalidate with
+If-None-Match and get a 304 instead of the body.
+"""
+
+import hashlib
+import json
+
+from flask import Blueprint, Response, abort, current_app, g, request
+from sqlalchemy import or_
+
+import membership
+import search
+from trending import trending
+from models import db, Follow, Like, Message, TimelineEntry, User
+from pagination import (keyset_page, like_cursor, message_cursor,
+                        parse_message_cursor, parse_rank_cursor,
+                        parse_user_cursor, user_cursor)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.likes_count,
+    Message.user_id,
+    User.username,
+    User.image_url,
+)
+
+USER_CARD_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.bio,
+)
+
+USER_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+    User.location,
+    User.messages_count,
+    User.following_count,
+    User.followers_count,
+    User.likes_count,
+)
+
+
+def dumps(data):
+    """Encode `data` as compact JSON bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'), default=str).encode()
+
+
+def json_response(data, status=200):
+    """JSON response with a strong ETag, answered with 304 when the client
+    already has this representation."""
+
+    body = dumps(data)
+    response = Response(body, status=status, mimetype='application/json')
+
+    if status == 200:
+        response.set_etag(hashlib.blake2b(body, digest_size=16).hexdigest())
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.make_conditional(request)
+
+    return response
+
+
+def error(message, status):
+    return json_response({'error': message}, status)
+
+
+@api.before_request
+def require_login():
+    if not g.user:
+        return error("Access unauthorized.", 401)
+
+
+def serialize_messages(rows):
+    """Message rows (MESSAGE_COLUMNS) as dicts, with the viewer's likes."""
+
+    liked = membership.liked_ids(g.user.id, [row.id for row in rows])
+
+    return [
+        {
+            'id': row.id,
+            'text': row.text,
+            'timestamp': row.timestamp.isoformat(),
+            'likes_count': row.likes_count,
+            'liked': row.id in liked,
+            'user': {
+                'id': row.user_id,
+                'username': row.username,
+                'image_url': row.image_url,
+            },
+        }
+        for row in rows
+    ]
+
+
+def serialize_user_cards(rows):
+    """User rows (USER_CARD_COLUMNS) as dicts, with the viewer's follows."""
+
+    followed = membership.followed_ids(g.user.id, [row.id for row in rows])
+
+    return [
+        dict(row._asdict(), following=row.id in followed)
+        for row in rows
+    ]
+
+
+def message_page(query, columns=(Message.timestamp, Message.id),
+                 make_cursor=message_cursor):
+    page = keyset_page(
+        query,
+        columns,
+        parse_message_cursor(request.args.get('before')),
+        current_app.config['MESSAGES_PER_PAGE'],
+        make_cursor,
+    )
+
+    return json_response({
+        'items': serialize_messages(page.items),
+        'next_cursor': page.next_cursor,
+    })
+
+
+def user_page(query):
+    page = keyset_page(
+        query.filter(User.deleted_at.is_(None)),
+        (User.id,),
+        parse_user_cursor(request.args.get('before')),
+        current_app.config['USERS_PER_PAGE'],
+        user_cursor,
+    )
+
+    return json_response({
+        'items': serialize_user_cards(page.items),
+        'next_cursor': page.next_cursor,
+    })
+
+
+def messages_query():
+    return (db.session
+            .query(*MESSAGE_COLUMNS)
+            .join(User, User.id == Message.user_id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def ensure_user(user_id):
+    exists = db.session.execute(
+        db.select(User.id)
+        .where(User.id == user_id)
+        .where(User.deleted_at.is_(None))
+    ).scalar_one_or_none()
+    if exists is None:
+        abort(404)
+
+
+@api.errorhandler(404)
+def not_found(e):
+    return error("Not found.", 404)
+
+
+@api.errorhandler(400)
+def bad_request(e):
+    return error("Bad request.", 400)
+
+
+@api.get('/timeline')
+def timeline():
+    """The viewer's home timeline, newest first."""
+
+    if not current_app.config['USE_MATERIALIZED_TIMELINES']:
+        following_ids = (db.select(Follow.user_being_followed_id)
+                         .where(Follow.user_following_id == g.user.id))
+        return message_page(
+            messages_query()
+            .filter(or_(Message.user_id == g.user.id,
+                        Message.user_id.in_(following_ids))))
+
+    page = keyset_page(
+        (messages_query()
+         .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+         .filter(TimelineEntry.user_id == g.user.id)),
+        (TimelineEntry.timestamp, TimelineEntry.message_id),
+        parse_message_cursor(request.args.get('before')),
+        current_app.config['MESSAGES_PER_PAGE'],
+        message_cursor,
+    )
+
+    return json_response({
+        'items': serialize_messages(page.items),
+        'next_cursor': page.next_cursor,
+    })
+
+
+@api.get('/users/<int:user_id>')
+def user(user_id):
+    """A user's profile and counters."""
+
+    row = db.session.execute(
+        db.select(*USER_COLUMNS)
+        .where(User.id == user_id)
+        .where(User.deleted_at.is_(None))
+    ).one_or_none()
+
+    if row is None:
+        abort(404)
+
+    return json_response(dict(
+        row._asdict(),
+        following=bool(membership.followed_ids(g.user.id, [user_id])),
+    ))
+
+
+@api.get('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    ensure_user(user_id)
+    return message_page(messages_query().filter(Message.user_id == user_id))
+
+
+@api.get('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages a user has liked, most recently liked first."""
+
+    ensure_user(user_id)
+    return message_page(
+        messages_query()
+        .add_columns(Like.timestamp.label('liked_at'))
+        .join(Like, Like.message_id == Message.id)
+        .filter(Like.user_id == user_id),
+        (Like.timestamp, Like.message_id),
+        lambda row: like_cursor(row.liked_at, row.id),
+    )
+
+
+@api.get('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users this user follows."""
+
+    ensure_user(user_id)
+    return user_page(
+        db.session
+        .query(*USER_CARD_COLUMNS)
+        .join(Follow, Follow.user_being_followed_id == User.id)
+        .filter(Follow.user_following_id == user_id))
+
+
+@api.get('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following this user."""
+
+    ensure_user(user_id)
+    return user_page(
+        db.session
+        .query(*USER_CARD_COLUMNS)
+        .join(Follow, Follow.user_following_id == User.id)
+        .filter(Follow.user_being_followed_id == user_id))
+
+
+@api.get('/trending')
+def trending_messages():
+    """The most-liked messages of late, best first, with their scores."""
+
+    limit = request.args.get('limit', trending.size, type=int)
+    top = trending.top(max(limit, 1))
+
+    items = serialize_messages([row for row, _ in top])
+    for item, (_, score) in zip(items, top):
+        item['score'] = round(score, 3)
+
+    return json_response({'items': items})
+
+
+@api.get('/messages/<int:message_id>')
+def message(message_id):
+    """A single message."""
+
+    row = messages_query().filter(Message.id == message_id).one_or_none()
+
+    if row is None:
+        abort(404)
+
+    return json_response(serialize_messages([row])[0])
+
+
+@api.get('/messages/search')
+def message_search():
+    """Messages matching 'q', best first; 'scope=following' limits results
+    to the viewer's timeline."""
+
+    q = request.args.get('q', '').strip()
+    if not q:
+        return error("Missing search query 'q'.", 400)
+
+    messages, next_cursor = search.search_messages(
+        q,
+        before=parse_rank_cursor(request.args.get('before')),
+        per_page=current_app.config['MESSAGES_PER_PAGE'],
+        viewer_id=(g.user.id if request.args.get('scope') == 'following'
+                   else None),
+    )
+
+    by_id = {}
+    if messages:
+        by_id = {row.id: row for row in messages_query().filter(
+            Message.id.in_([message.id for message in messages]))}
+
+    return json_response({
+        'items': serialize_messages(
+            [by_id[message.id] for message in messages
+             if message.id in by_id]),
+        'next_cursor': next_cursor,
+    })
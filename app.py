@@ -1,52 +1,89 @@
 import os
-from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort
+import click
+
+from flask import (Flask, Blueprint, render_template, request, flash, redirect,
+                   session, g, abort, jsonify, current_app)
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 from flask_cors import CORS
 
-from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditform
-from models import db, connect_db, User, Message
-
-load_dotenv()
+from forms import (UserAddForm, LoginForm, MessageForm, UserEditform,
+                   csrf_field, csrf_form)
+from config import PROFILES
+from models import db, connect_db, User, Message, Follow, Like
+from passwords import hasher, HashingBusy
+from throttle import login_throttle
+from fragments import fragment_cache
+from principal import load_principal, user_cache
+from jobs import job_runner
+from trending import trending
+from recommendations import recommender
+from graph import graph_index
+import principal
+from streaming import stream_page
+from pagination import (keyset_page, message_cursor, parse_message_cursor,
+                        like_cursor, user_cursor, parse_user_cursor,
+                        parse_rank_cursor)
+from api import api
+import caching
+import counters
+import follows
+import fragments
+import membership
+import purge
+import search
+import timelines
 
 CURR_USER_KEY_WARBLER = "curr_user_warbler"
+CURR_USER_KEY = CURR_USER_KEY_WARBLER
 
-app = Flask(__name__)
-CORS(app)
+views = Blueprint('warbler', __name__, cli_group=None)
 
-database_url = os.environ['DATABASE_URL']
-database_url = database_url.replace('postgres://', 'postgresql://')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
+toolbar = DebugToolbarExtension()
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a cached, read-only UserPrincipal; routes that change the user
+    load the ORM entity with load_user_entity().
+    """
 
     if CURR_USER_KEY_WARBLER in session:
-        g.user = User.query.get(session[CURR_USER_KEY_WARBLER])
+        g.user = load_principal(session[CURR_USER_KEY_WARBLER], user_cache)
     else:
         g.user = None
 
 
-@app.before_request
-def provide_CSRF_protection():
-    """Adding CSRF protection to Flask global object."""
+def load_user_entity():
+    """Load the full User model for the logged-in user."""
+
+    return User.query.get_or_404(g.user.id)
+
+
+def get_user_or_404(user_id):
+    """Load a user to show, 404ing for deleted accounts too."""
 
-    g.csrf_form = CSRFProtectForm()
+    return (User
+            .query
+            .filter(User.id == user_id, User.deleted_at.is_(None))
+            .first_or_404())
+
+
+@views.teardown_app_request
+def drop_CSRF_protection(exc):
+    """Forget this request's CSRF form and token (see forms.csrf_form)."""
+
+    g.pop('csrf_form', None)
+    g.pop('csrf_field', None)
+    g.pop(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), None)
 
 
 def do_login(user):
@@ -63,7 +100,7 @@ def do_logout():
         flash("Logged out")
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -88,6 +125,7 @@ def signup():
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
             db.session.commit()
+            search.index_user(user)
 
         except IntegrityError:
             flash("Username already taken", 'danger')
@@ -101,33 +139,47 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
 def login():
-    """Handle user login and redirect to homepage on success."""
+    """Handle user login and redirect to homepage on success.
+
+    Repeated failures for a username or from an IP are throttled before any
+    password checking is done.
+    """
 
     form = LoginForm()
 
     if form.validate_on_submit():
+        username = form.username.data
+        ip = request.remote_addr
+
+        if not login_throttle.allowed(username, ip):
+            flash("Too many failed logins. Please try again later.", 'danger')
+            return render_template('users/login.html', form=form), 429
+
         user = User.authenticate(
-            form.username.data,
+            username,
             form.password.data,
         )
 
         if user:
+            db.session.commit()
+            login_throttle.reset(username)
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
+        login_throttle.record_failure(username, ip)
         flash("Invalid credentials.", 'danger')
 
     return render_template('users/login.html', form=form)
 
 
-@app.post('/logout')
+@views.post('/logout')
 def logout():
     """Handle logout of user and redirect to homepage."""
 
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
 
@@ -143,28 +195,63 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@views.get('/users')
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location; results are ranked and paged with a 'page' param. Without 'q',
+    lists users newest first, paged with `?before=<id>`.
     """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    search = request.args.get('q')
+    q = request.args.get('q')
+    per_page = current_app.config['USERS_PER_PAGE']
+    next_cursor = next_page = None
+
+    if not q:
+        page = keyset_page(
+            User.query.filter(User.deleted_at.is_(None)),
+            (User.id,),
+            parse_user_cursor(request.args.get('before')),
+            per_page,
+            user_cursor,
+        )
+        users, next_cursor = page
 
-    if not search:
-        users = User.query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page_number = request.args.get('page', 1, type=int)
+        users, has_next = search.search_users(
+            q,
+            page=max(page_number, 1),
+            per_page=per_page,
+            limit=current_app.config['SEARCH_RESULT_LIMIT'],
+        )
+        next_page = page_number + 1 if has_next else None
+
+    following_ids = membership.followed_ids(
+        g.user.id, [user.id for user in users])
+
+    not_modified = caching.not_modified(
+        next_cursor, next_page, following_ids,
+        *((user.id, user.version) for user in users))
+    if not_modified:
+        return not_modified
 
-    return render_template('users/index.html', users=users)
+    return render_template(
+        'users/index.html',
+        users=users,
+        q=q,
+        next_cursor=next_cursor,
+        next_page=next_page,
+        following_ids=following_ids,
+    )
 
 
-@app.get('/users/<int:user_id>')
+@views.get('/users/<int:user_id>')
 def show_user(user_id):
     """Show user profile."""
 
@@ -172,12 +259,37 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-
-    return render_template('users/show.html', user=user)
-
-
-@app.get('/users/<int:user_id>/following')
+    user = get_user_or_404(user_id)
+
+    page = keyset_page(
+        Message.query.filter(Message.user_id == user.id),
+        (Message.timestamp, Message.id),
+        parse_message_cursor(request.args.get('before')),
+        current_app.config['MESSAGES_PER_PAGE'],
+        message_cursor,
+    )
+
+    liked_ids = membership.liked_ids(
+        g.user.id, [message.id for message in page.items])
+    following_ids = membership.followed_ids(g.user.id, [user.id])
+
+    not_modified = caching.not_modified(
+        user.version, liked_ids, following_ids,
+        *(message.id for message in page.items))
+    if not_modified:
+        return not_modified
+
+    return stream_page(
+        'users/show.html',
+        user=user,
+        messages=page.items,
+        next_cursor=page.next_cursor,
+        liked_ids=liked_ids,
+        following_ids=following_ids,
+    )
+
+
+@views.get('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -185,11 +297,39 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
-
-
-@app.get('/users/<int:user_id>/followers')
+    user = get_user_or_404(user_id)
+
+    page = keyset_page(
+        (User
+         .query
+         .join(Follow, Follow.user_being_followed_id == User.id)
+         .filter(Follow.user_following_id == user.id)
+         .filter(User.deleted_at.is_(None))),
+        (User.id,),
+        parse_user_cursor(request.args.get('before')),
+        current_app.config['USERS_PER_PAGE'],
+        user_cursor,
+    )
+
+    following_ids = membership.followed_ids(
+        g.user.id, [user.id] + [other.id for other in page.items])
+
+    not_modified = caching.not_modified(
+        user.version, following_ids,
+        *((other.id, other.version) for other in page.items))
+    if not_modified:
+        return not_modified
+
+    return stream_page(
+        'users/following.html',
+        user=user,
+        users=page.items,
+        next_cursor=page.next_cursor,
+        following_ids=following_ids,
+    )
+
+
+@views.get('/users/<int:user_id>/followers')
 def show_followers(user_id):
     """Show list of followers of this user."""
 
@@ -197,57 +337,125 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
-
-
-@app.post('/users/follow/<int:follow_id>')
+    user = get_user_or_404(user_id)
+
+    page = keyset_page(
+        (User
+         .query
+         .join(Follow, Follow.user_following_id == User.id)
+         .filter(Follow.user_being_followed_id == user.id)
+         .filter(User.deleted_at.is_(None))),
+        (User.id,),
+        parse_user_cursor(request.args.get('before')),
+        current_app.config['USERS_PER_PAGE'],
+        user_cursor,
+    )
+
+    following_ids = membership.followed_ids(
+        g.user.id, [user.id] + [other.id for other in page.items])
+
+    not_modified = caching.not_modified(
+        user.version, following_ids,
+        *((other.id, other.version) for other in page.items))
+    if not_modified:
+        return not_modified
+
+    return stream_page(
+        'users/followers.html',
+        user=user,
+        users=page.items,
+        next_cursor=page.next_cursor,
+        following_ids=following_ids,
+    )
+
+
+@views.post('/users/follow/<int:follow_id>')
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
 
     Redirect to following page for the current for the current user.
     """
 
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
 
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = get_user_or_404(follow_id)
+    follows.follow(g.user.id, [followed_user.id])
     db.session.commit()
+    user_cache.invalidate(g.user.id, followed_user.id)
 
     return_url = request.form['url']
 
     return redirect(f"{return_url}")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@views.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
 
     Redirect to following page for the current for the current user.
     """
 
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
 
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = get_user_or_404(follow_id)
+    follows.unfollow(g.user.id, [followed_user.id])
     db.session.commit()
+    user_cache.invalidate(g.user.id, followed_user.id)
 
     return_url = request.form['url']
 
     return redirect(f"{return_url}")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@views.post('/users/follow/bulk')
+def bulk_follow():
+    """Follow many users at once for the currently-logged-in user.
+
+    Takes 'user_ids' as a JSON list or a comma-separated form field, and
+    'action' of 'follow' (default) or 'unfollow'. Responds with the ids that
+    changed as JSON.
+    """
+
+    form = csrf_form()
+
+    if not g.user or not form.validate_on_submit():
+        return jsonify(error="Access unauthorized."), 401
+
+    data = request.get_json(silent=True) or request.form
+    user_ids = data.get('user_ids', [])
+
+    try:
+        if isinstance(user_ids, str):
+            user_ids = [part for part in user_ids.split(',') if part.strip()]
+        user_ids = [int(user_id) for user_id in user_ids]
+    except (TypeError, ValueError):
+        return jsonify(error="user_ids must be a list of integers."), 400
+
+    if len(user_ids) > current_app.config['BULK_FOLLOW_LIMIT']:
+        return jsonify(error="Too many user_ids."), 400
+
+    if data.get('action', 'follow') == 'unfollow':
+        changed = follows.unfollow(g.user.id, user_ids)
+    else:
+        changed = follows.follow(g.user.id, user_ids)
+
+    db.session.commit()
+    user_cache.invalidate(g.user.id, *changed)
+
+    return jsonify(changed=changed)
+
+
+@views.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -255,43 +463,58 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    form = UserEditform(obj=g.user)
+    user = load_user_entity()
+    form = UserEditform(obj=user)
 
     if form.validate_on_submit():
-        result = g.user.authenticate(g.user.username, form.password.data)
+        result = user.authenticate(user.username, form.password.data)
 
         if result:
-            g.user.username = form.username.data
-            g.user.email = form.email.data
-            g.user.bio = form.bio.data
-            g.user.header_image_url = form.header_image_url.data
-            g.user.image_url = form.image_url.data
+            user.username = form.username.data
+            user.email = form.email.data
+            user.bio = form.bio.data
+            user.header_image_url = form.header_image_url.data
+            user.image_url = form.image_url.data
+            user.version = User.version + 1
+            user.profile_version = User.profile_version + 1
 
             db.session.commit()
+            user_cache.invalidate(user.id)
+            fragments.invalidate_user(user.id)
+            search.index_user(user)
 
-            return redirect(f'/users/{g.user.id}')
+            return redirect(f'/users/{user.id}')
 
         flash("Please enter correct password to submit updates.", "danger")
 
     return render_template("users/edit.html", form=form, user_id=g.user.id)
 
 
-@app.post('/users/delete')
+@views.post('/users/delete')
 def delete_user():
     """Delete user.
     Redirect to signup page.
+
+    The account is hidden at once; its messages, follows and likes are
+    removed in the background (see purge.py).
     """
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
 
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    Message.query.filter(Message.user_id == g.user.id).delete()
-
-    db.session.delete(g.user)
+    purge.soft_delete(g.user.id)
+    # Enqueued last: the purge commits as it goes, which in inline mode
+    # commits this transaction too
+    job_runner.enqueue('purge_user', key=f'purge:{g.user.id}',
+                       user_id=g.user.id)
     db.session.commit()
+    user_cache.invalidate(g.user.id)
+    fragments.invalidate_user(g.user.id)
+    search.unindex_user(g.user.id)
+    search.unindex_user_messages(g.user.id)
 
     do_logout()
     return redirect("/signup")
@@ -300,7 +523,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/messages/new', methods=["GET", "POST"])
 def add_message():
     """Add a message:
     Show form if GET. If valid, update message and redirect to user page.
@@ -314,16 +537,73 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        timelines.fan_out_message(msg)
+        counters.adjust(g.user.id, messages_count=1)
+        trending.record_message(msg)
         db.session.commit()
+        user_cache.invalidate(g.user.id)
+        search.index_message(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@views.get('/messages/search')
+def search_messages():
+    """Search messages by text.
+
+    Takes a 'q' param with the search terms; 'scope=following' limits results
+    to the viewer's home timeline. Results are ranked and paged with
+    `?before=<rank,id>`. Responds with JSON when the client prefers it.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    q = request.args.get('q', '').strip()
+    scope = request.args.get('scope', 'all')
+    messages, next_cursor = [], None
+
+    if q:
+        messages, next_cursor = search.search_messages(
+            q,
+            before=parse_rank_cursor(request.args.get('before')),
+            per_page=current_app.config['MESSAGES_PER_PAGE'],
+            viewer_id=g.user.id if scope == 'following' else None,
+        )
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(
+            messages=[
+                {
+                    "id": message.id,
+                    "text": message.text,
+                    "timestamp": message.timestamp.isoformat(),
+                    "user_id": message.user_id,
+                    "username": message.user.username,
+                }
+                for message in messages
+            ],
+            next_cursor=next_cursor,
+        )
+
+    return render_template(
+        'messages/search.html',
+        q=q,
+        scope=scope,
+        messages=messages,
+        next_cursor=next_cursor,
+        liked_ids=membership.liked_ids(
+            g.user.id, [message.id for message in messages]),
+    )
+
+
+@views.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
 
@@ -331,11 +611,28 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message
+           .query
+           .options(db.joinedload(Message.user))
+           .join(User, User.id == Message.user_id)
+           .filter(Message.id == message_id, User.deleted_at.is_(None))
+           .first_or_404())
+
+    following_ids = membership.followed_ids(g.user.id, [msg.user_id])
+
+    not_modified = caching.not_modified(
+        msg.id, msg.user.version, following_ids)
+    if not_modified:
+        return not_modified
 
+    return render_template(
+        'messages/show.html',
+        message=msg,
+        following_ids=following_ids,
+    )
 
-@app.post('/messages/<int:message_id>/delete')
+
+@views.post('/messages/<int:message_id>/delete')
 def delete_message(message_id):
     """Delete a message.
 
@@ -343,7 +640,7 @@ def delete_message(message_id):
     Redirect to user page on success.
     """
 
-    form = g.csrf_form
+    form = csrf_form()
     msg = Message.query.get_or_404(message_id)
 
     if not g.user or not form.validate_on_submit() or g.user.id != msg.user_id:
@@ -351,8 +648,13 @@ def delete_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    timelines.remove_message(msg.id)
+    counters.remove_message(msg)
     db.session.delete(msg)
     db.session.commit()
+    user_cache.invalidate(g.user.id)
+    fragments.invalidate_message(message_id)
+    search.unindex_message(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -361,62 +663,116 @@ def delete_message(message_id):
 # Homepage and error pages
 
 
-@app.get('/')
+@views.get('/')
 def homepage():
     """Show homepage:
     - anon users: no messages
-    - logged in: 100 most recent messages of self & followed_users
+    - logged in: most recent messages of self & followed_users, one page at
+      a time; `?before=<timestamp,id>` continues after a previous page
+
+    Reads the materialized timeline unless USE_MATERIALIZED_TIMELINES is off,
+    in which case messages are queried from the followed users directly.
     """
 
-    if g.user:
-        list_of_following_id = [
-            user.id for user in g.user.following] + [g.user.id]
+    if not g.user:
+        return render_template('home-anon.html')
 
-        messages = (Message
-                    .query
-                    .order_by(Message.timestamp.desc())
-                    .filter(Message.user_id.in_(list_of_following_id))
-                    .limit(100)
-                    .all())
+    before = parse_message_cursor(request.args.get('before'))
+    per_page = current_app.config['MESSAGES_PER_PAGE']
 
-        return render_template('home.html', messages=messages)
+    if current_app.config['USE_MATERIALIZED_TIMELINES']:
+        page = timelines.read_timeline(g.user.id, before, per_page)
 
     else:
-        return render_template('home-anon.html')
+        following_ids = (db.select(Follow.user_being_followed_id)
+                         .where(Follow.user_following_id == g.user.id))
+
+        page = keyset_page(
+            (Message
+             .query
+             .options(db.joinedload(Message.user))
+             .join(User, User.id == Message.user_id)
+             .filter(or_(Message.user_id == g.user.id,
+                         Message.user_id.in_(following_ids)))
+             .filter(User.deleted_at.is_(None))),
+            (Message.timestamp, Message.id),
+            before,
+            per_page,
+            message_cursor,
+        )
+
+    trending_messages = trending.top(
+        current_app.config['TRENDING_PANEL_SIZE'])
+    suggestions = recommender.for_user(
+        g.user, current_app.config['RECOMMENDATIONS_PANEL_SIZE'])
+
+    liked_ids = membership.liked_ids(
+        g.user.id, [message.id for message in page.items])
+
+    not_modified = caching.not_modified(
+        tuple(row.id for row, _ in trending_messages),
+        tuple(user.id for user in suggestions),
+        liked_ids,
+        *((message.id, message.user.version) for message in page.items))
+    if not_modified:
+        return not_modified
+
+    return stream_page(
+        'home.html',
+        messages=page.items,
+        next_cursor=page.next_cursor,
+        trending=trending_messages,
+        suggestions=suggestions,
+        liked_ids=liked_ids,
+    )
 
 ##############################################################################
 # like messages
 
 
-@app.post("/message/<int:message_id>/like")
+@views.post("/message/<int:message_id>/like")
 def toggle_like(message_id):
-    """Get current message based on message.id and append to liked_messages
-     depending on current user """
+    """Like the message if the current user hasn't yet, otherwise unlike it.
+
+    Responds with the new like state and count as JSON when the client
+    prefers it; otherwise redirects back to the form's 'url'.
+    """
 
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
+    author_id = db.session.execute(
+        db.select(Message.user_id)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id == message_id)
+        .where(User.deleted_at.is_(None))
+    ).scalar_one_or_none()
 
-    if message.user_id == g.user.id:
-        return abort(403)
+    if author_id is None:
+        abort(404)
 
-    if message in g.user.liked_messages:
-        g.user.liked_messages.remove(message)
-    else:
-        g.user.liked_messages.append(message)
+    if author_id == g.user.id:
+        return abort(403)
 
+    liked, changed, likes_count, liked_at = Like.toggle(
+        g.user.id, message_id)
+    if changed:
+        trending.record_like(message_id, liked, liked_at)
     db.session.commit()
+    user_cache.invalidate(g.user.id)
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(liked=liked, likes_count=likes_count)
 
     return_url = request.form['url']
 
     return redirect(f"{return_url}")
 
 
-@app.get('/users/<int:user_id>/liked_messages')
+@views.get('/users/<int:user_id>/liked_messages')
 def show_liked_messages(user_id):
     """Show list of liked messages of this user."""
 
@@ -424,20 +780,196 @@ def show_liked_messages(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/liked_messages.html', user=user)
+    user = get_user_or_404(user_id)
+
+    # Newest likes first, read off ix_likes_user_id_timestamp
+    page = keyset_page(
+        (Message
+         .query
+         .add_columns(Like.timestamp.label('liked_at'))
+         .options(db.joinedload(Message.user))
+         .join(Like, Like.message_id == Message.id)
+         .join(User, User.id == Message.user_id)
+         .filter(Like.user_id == user.id)
+         .filter(User.deleted_at.is_(None))),
+        (Like.timestamp, Like.message_id),
+        parse_message_cursor(request.args.get('before')),
+        current_app.config['MESSAGES_PER_PAGE'],
+        lambda row: like_cursor(row.liked_at, row.Message.id),
+    )
+    messages = [row.Message for row in page.items]
+
+    liked_ids = membership.liked_ids(
+        g.user.id, [message.id for message in messages])
+    following_ids = membership.followed_ids(g.user.id, [user.id])
+
+    not_modified = caching.not_modified(
+        user.version, liked_ids, following_ids,
+        *((message.id, message.user.version) for message in messages))
+    if not_modified:
+        return not_modified
+
+    return stream_page(
+        'users/liked_messages.html',
+        user=user,
+        messages=messages,
+        next_cursor=page.next_cursor,
+        liked_ids=liked_ids,
+        following_ids=following_ids,
+    )
+
+
+##############################################################################
+# CLI commands
+
+
+@views.cli.command('backfill-timelines')
+def backfill_timelines():
+    """Rebuild every user's home timeline from messages and follows."""
+
+    count = timelines.backfill()
+    print(f"Wrote {count} timeline entries.")
+
+
+@views.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute every user's message/follow/like counters."""
+
+    counters.reconcile()
+    print("Counters reconciled.")
+
+
+@views.cli.command('backfill-like-timestamps')
+def backfill_like_timestamps():
+    """Date likes stored without a timestamp from their message."""
+
+    count = Like.backfill_timestamps()
+    db.session.commit()
+    print(f"Dated {count} likes.")
+
+
+@views.cli.command('compact-trending')
+def compact_trending():
+    """Drop trending windows that have aged out."""
+
+    count = trending.compact()
+    db.session.commit()
+    print(f"Deleted {count} trending scores.")
+
 
-@app.errorhandler(404)
+@views.cli.command('recommend')
+def recommend():
+    """Recompute every user's who-to-follow suggestions."""
+
+    report = recommender.recompute()
+    db.session.commit()
+    print(f"Recommendations for {report['users']} users over "
+          f"{report['edges']} follows in {report['seconds']:.1f}s "
+          f"({report['changed']} changed).")
+
+
+@views.cli.command('graph-stats')
+def graph_stats():
+    """Build the follow graph index and report its size."""
+
+    graph_index.build()
+    stats = graph_index.stats()
+    print(f"{stats['users']} user ids, {stats['edges']} follows: "
+          f"{stats['bytes'] / 2**20:.1f} MiB "
+          f"({stats['bytes_per_million_edges'] / 2**20:.1f} MiB per million "
+          f"follows).")
+
+
+@views.cli.command('run-jobs')
+@click.option('--once', is_flag=True,
+              help="Exit once no jobs are due instead of polling.")
+@click.option('--poll-interval', default=1.0, show_default=True,
+              help="Seconds to wait when no jobs are due.")
+def run_jobs(once, poll_interval):
+    """Run background jobs from the jobs table (JOBS_MODE=queue)."""
+
+    count = job_runner.work(poll_interval=poll_interval, once=once)
+    print(f"Ran {count} jobs.")
+
+
+@views.cli.command('purge-users')
+def purge_users():
+    """Finish purging every deleted account, e.g. after a purge job failed
+    for good."""
+
+    for user_id in purge.pending_user_ids():
+        report = purge.purge_user(
+            user_id, current_app.config['PURGE_BATCH_SIZE'])
+        removed = ', '.join(f"{count} {table}" for table, count in
+                            report.items() if table not in (
+                                'seconds', 'rows_per_second'))
+        print(f"User {user_id}: removed {removed} in "
+              f"{report['seconds']:.2f}s "
+              f"({report['rows_per_second']:.0f} rows/s).")
+
+
+@views.app_errorhandler(404)
 def page_not_found(e):
     """404 NOT FOUND page."""
 
     return render_template('404.html'), 404
 
 
-@app.after_request
+@views.app_errorhandler(HashingBusy)
+def hashing_busy(e):
+    """503 when the password hashing queue is full."""
+
+    db.session.rollback()
+    return render_template('503.html'), 503, {'Retry-After': '1'}
+
+
+@views.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add caching headers: an ETag and a private max-age for pages that
+    opted in through caching.not_modified(), no-store for everything else
+    that doesn't set its own policy."""
+
+    return caching.apply_policy(response)
+
+
+##############################################################################
+# Application factory
+
+
+def create_app(config='development'):
+    """Build the Warbler app with `config`, a profile name from
+    config.PROFILES or a config class."""
+
+    if isinstance(config, str):
+        config = PROFILES[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    if not app.config['SECRET_KEY']:
+        # Sessions and CSRF tokens would be signed with no key at all
+        raise RuntimeError("SECRET_KEY must be set")
+
+    if app.config['CORS_ORIGINS']:
+        CORS(app, origins=app.config['CORS_ORIGINS'].split(','))
+
+    if app.config['DEBUG_TOOLBAR']:
+        toolbar.init_app(app)
+
+    connect_db(app)
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+    hasher.init_app(app)
+    login_throttle.init_app(app)
+    principal.init_app(app)
+    fragment_cache.init_app(app)
+    job_runner.init_app(app)
+    trending.init_app(app)
+    recommender.init_app(app)
+    graph_index.init_app(app)
+    app.add_template_global(csrf_field)
+
+    return app
+
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
+app = create_app(os.environ.get('WARBLER_CONFIG', 'development'))
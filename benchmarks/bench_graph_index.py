@@ -0,0 +1,132 @@
+"""Benchmark the in-process follow graph index against SQL lookups.
+
+Loads a synthetic follow graph (`--users` users and about `--edges` follows,
+generated as in bench_recommendations.py) into a temporary SQLite database,
+builds graph.GraphIndex from it, and reports build time, memory per million
+follows and the latency of "does A follow B", "who does A follow" and
+"how many followers does B have", next to the `follows` queries they
+replace. Lookups go through the principal cache, as in a request.
+
+    python benchmarks/bench_graph_index.py
+    python benchmarks/bench_graph_index.py --users 10000 --edges 100000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_recommendations import make_edges  # noqa: E402
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p50 = statistics.median(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"  {name}: p50 {p50 * 1e6:.1f} us, p99 {p99 * 1e6:.1f} us")
+
+
+def load(users, edges):
+    from models import db, Follow, User
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(db.insert(User), [
+        {'id': user_id, 'email': f"user{user_id}@example.com",
+         'username': f"user{user_id}", 'password': "x"}
+        for user_id in range(1, users + 1)
+    ])
+    db.session.execute(db.insert(Follow), [
+        {'user_following_id': follower, 'user_being_followed_id': followed}
+        for follower, followed in edges
+    ])
+    db.session.commit()
+
+
+def time_calls(fn, args):
+    timings = []
+    for arg in args:
+        start = time.perf_counter()
+        fn(*arg)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--edges', type=int, default=1_000_000)
+    parser.add_argument('--lookups', type=int, default=10_000)
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ['DATABASE_URL'] = f"sqlite:///{database}"
+    os.environ.setdefault('SECRET_KEY', 'bench')
+
+    from app import app
+    from graph import graph_index
+    from models import db, Follow
+    from principal import user_cache
+
+    user_cache.maxsize = args.users
+
+    with app.app_context():
+        start = time.perf_counter()
+        edges = make_edges(args.users, args.edges)
+        load(args.users, edges)
+        print(f"loaded {len(edges):,} follows in "
+              f"{time.perf_counter() - start:.1f} s")
+
+        start = time.perf_counter()
+        graph_index.build()
+        stats = graph_index.stats()
+        print(f"built index in {time.perf_counter() - start:.2f} s: "
+              f"{stats['bytes'] / 2**20:.1f} MiB, "
+              f"{stats['bytes_per_million_edges'] / 2**20:.1f} MiB per "
+              f"million follows")
+
+        rng = random.Random(1)
+        pairs = [(rng.randint(1, args.users), rng.randint(1, args.users))
+                 for _ in range(args.lookups)]
+        singles = [(a,) for a, _ in pairs]
+
+        # Warm the principal cache, as the request's own user would be
+        time_calls(graph_index.following, singles)
+
+        print("index:")
+        report("is_following", time_calls(graph_index.is_following, pairs))
+        report("following", time_calls(graph_index.following, singles))
+        report("follower_count",
+               time_calls(graph_index.follower_count, singles))
+
+        def sql_is_following(a, b):
+            return db.session.scalar(
+                db.select(db.exists()
+                          .where(Follow.user_following_id == a)
+                          .where(Follow.user_being_followed_id == b)))
+
+        def sql_following(a):
+            return db.session.scalars(
+                db.select(Follow.user_being_followed_id)
+                .where(Follow.user_following_id == a)).all()
+
+        def sql_follower_count(b):
+            return db.session.scalar(
+                db.select(db.func.count())
+                .where(Follow.user_being_followed_id == b))
+
+        print("SQL on SQLite:")
+        report("is_following", time_calls(sql_is_following, pairs))
+        report("following", time_calls(sql_following, singles))
+        report("follower_count", time_calls(sql_follower_count, singles))
+
+
+if __name__ == '__main__':
+    main()
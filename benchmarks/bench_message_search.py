@@ -0,0 +1,139 @@
+"""Benchmark message search over generator/messages.csv scaled up.
+
+Each CSV row is repeated `--scale` times (1000 by default, about a million
+messages) and the search path is timed on a set of queries drawn from the
+data.
+
+By default this exercises the in-process inverted index used when the app
+is not on PostgreSQL. With `--database`, the scaled rows are loaded into
+that database (which must already have the Warbler schema and users, e.g.
+from seed.py) and `search.search_messages` is timed through the app, which
+uses the GIN full-text index on PostgreSQL.
+
+    python benchmarks/bench_message_search.py --scale 100
+    python benchmarks/bench_message_search.py --database postgresql:///warbler_bench
+"""
+
+import argparse
+import csv
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MESSAGES_CSV = os.path.join(ROOT, 'generator', 'messages.csv')
+
+
+def read_messages():
+    with open(MESSAGES_CSV) as messages:
+        return [(row['text'], int(row['user_id']))
+                for row in csv.DictReader(messages)]
+
+
+def sample_queries(rows, count, seed=0):
+    """Pick one- and two-word queries from the message texts."""
+
+    from search import terms
+
+    rng = random.Random(seed)
+    queries = []
+    while len(queries) < count:
+        words = terms(rng.choice(rows)[0])
+        if words:
+            queries.append(" ".join(rng.sample(words, min(len(words),
+                                                          rng.choice((1, 2))))))
+    return queries
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p50 = statistics.median(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{name}: {len(timings)} queries, "
+          f"p50 {p50 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms")
+
+
+def bench_index(rows, scale, queries):
+    from search import TermIndex
+
+    index = TermIndex()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    message_id = 0
+    for _ in range(scale):
+        for text, user_id in rows:
+            message_id += 1
+            index.add(message_id, user_id, text)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"indexed {message_id:,} messages in {elapsed:.1f} s "
+          f"({message_id / elapsed:,.0f}/s), peak {peak / 2**20:,.0f} MiB")
+
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        results = index.search(query)[:50]
+        timings.append(time.perf_counter() - start)
+    report("in-process index, top 50", timings)
+
+
+def bench_database(rows, scale, queries, database_url):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('SECRET_KEY', 'bench')
+
+    from app import app
+    from models import db, Message, User
+    import search
+
+    with app.app_context():
+        user_ids = [user_id for user_id, in db.session.execute(
+            db.select(User.id))]
+        if not user_ids:
+            sys.exit("Load users first (e.g. python seed.py).")
+
+        start = time.perf_counter()
+        for _ in range(scale):
+            db.session.execute(
+                db.insert(Message),
+                [{'text': text, 'user_id': user_ids[user_id % len(user_ids)]}
+                 for text, user_id in rows],
+            )
+        db.session.commit()
+        elapsed = time.perf_counter() - start
+        print(f"loaded {len(rows) * scale:,} messages in {elapsed:.1f} s")
+
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            search.search_messages(query, per_page=50)
+            timings.append(time.perf_counter() - start)
+        report(f"search_messages on {db.engine.dialect.name}, top 50",
+               timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--scale', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--database')
+    args = parser.parse_args()
+
+    rows = read_messages()
+    queries = sample_queries(rows, args.queries)
+
+    if args.database:
+        bench_database(rows, args.scale, queries, args.database)
+    else:
+        bench_index(rows, args.scale, queries)
+
+
+if __name__ == '__main__':
+    main()
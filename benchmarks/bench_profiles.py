@@ -0,0 +1,115 @@
+"""Compare startup and per-request overhead of the config profiles.
+
+For each profile, times `create_app` and a set of requests through the test
+client against a small SQLite database: the anonymous login page, the home
+timeline and a profile page for a logged-in user. The development profile
+is also measured with DEBUG on, which is when the debug toolbar installs its
+instrumentation.
+
+    python benchmarks/bench_profiles.py --requests 500
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p50 = statistics.median(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"  {name}: p50 {p50 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms")
+
+
+def seed(users, messages_per_user):
+    from models import db, Message, User
+
+    db.drop_all()
+    db.create_all()
+
+    for i in range(users):
+        user = User.signup(f"user{i}", f"user{i}@example.com", "password",
+                           None)
+        db.session.flush()
+        db.session.add_all(Message(text=f"message {n} from user {i}",
+                                   user_id=user.id)
+                           for n in range(messages_per_user))
+    db.session.commit()
+
+    import counters
+    import timelines
+    timelines.backfill()
+    counters.reconcile()
+
+    return db.session.scalar(db.select(User.id).order_by(User.id))
+
+
+def time_requests(app, user_id, count):
+    from app import CURR_USER_KEY_WARBLER
+
+    client = app.test_client()
+    anonymous = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY_WARBLER] = user_id
+
+    for name, c, path in (
+        ("GET /login (anonymous)", anonymous, "/login"),
+        ("GET /", client, "/"),
+        (f"GET /users/{user_id}", client, f"/users/{user_id}"),
+    ):
+        timings = []
+        for i in range(count):
+            start = time.perf_counter()
+            c.get(path).get_data()
+            timings.append(time.perf_counter() - start)
+        report(name, timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per page and profile")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=20,
+                        help="messages per user")
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{database}"
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("BCRYPT_LOG_ROUNDS", "4")
+    os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+
+    start = time.perf_counter()
+    import app as warbler
+    from config import DevelopmentConfig
+    print(f"import app: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    with warbler.app.app_context():
+        user_id = seed(args.users, args.messages)
+
+    profiles = [
+        ("production", "production"),
+        ("testing", "testing"),
+        ("development", "development"),
+        ("development+DEBUG",
+         type("DebugConfig", (DevelopmentConfig,), {"DEBUG": True})),
+    ]
+
+    for name, config in profiles:
+        start = time.perf_counter()
+        app = warbler.create_app(config)
+        elapsed = time.perf_counter() - start
+
+        print(f"{name}: create_app {elapsed * 1000:.1f} ms")
+        time_requests(app, user_id, args.requests)
+
+
+if __name__ == "__main__":
+    main()
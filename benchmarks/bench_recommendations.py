@@ -0,0 +1,129 @@
+"""Benchmark who-to-follow recommendations on a synthetic follow graph.
+
+Generates `--users` users and about `--edges` follows (followers picked
+uniformly, followed users skewed towards a popular few, as on real social
+graphs), builds the in-memory CSR graph from them and times a full
+recompute of every user's top `--size` suggestions, as the
+'recompute_recommendations' job does (minus the database reads and writes).
+numpy is used when installed; `--no-numpy` times the pure-Python fallback.
+
+For comparison, the same edges are loaded into an in-memory SQLite database
+and the friends-of-friends self-join a per-request implementation would run
+is timed for `--sql-sample` users, then extrapolated to all of them.
+
+    python benchmarks/bench_recommendations.py
+    python benchmarks/bench_recommendations.py --users 10000 --edges 100000 --no-numpy
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FRIENDS_OF_FRIENDS_SQL = """
+    SELECT second.user_being_followed_id, count(*) AS score
+    FROM follows AS first
+    JOIN follows AS second
+        ON second.user_following_id = first.user_being_followed_id
+    WHERE first.user_following_id = :user_id
+      AND second.user_being_followed_id != :user_id
+      AND second.user_being_followed_id NOT IN (
+          SELECT user_being_followed_id FROM follows
+          WHERE user_following_id = :user_id)
+    GROUP BY second.user_being_followed_id
+    ORDER BY score DESC, second.user_being_followed_id
+    LIMIT :limit
+"""
+
+
+def make_edges(users, edges, seed=0):
+    """Return sorted, distinct (follower, followed) pairs of ids 1..users."""
+
+    rng = random.Random(seed)
+    pairs = set()
+    while len(pairs) < edges:
+        follower = rng.randint(1, users)
+        followed = 1 + int(users * rng.random() ** 2)
+        if follower != followed:
+            pairs.add((follower, followed))
+    return sorted(pairs)
+
+
+def bench_graph(user_ids, edges, size, batch_size):
+    from recommendations import FollowGraph
+
+    start = time.perf_counter()
+    graph = FollowGraph.from_edges(user_ids, edges)
+    built = time.perf_counter() - start
+    print(f"built CSR graph of {len(graph):,} users and {graph.edges:,} "
+          f"follows in {built:.2f} s")
+
+    start = time.perf_counter()
+    suggested = 0
+    for first in range(0, len(graph), batch_size):
+        rows = range(first, min(first + batch_size, len(graph)))
+        suggested += sum(map(len, graph.recommend(rows, size)))
+    elapsed = time.perf_counter() - start
+    print(f"recomputed top {size} for {len(graph):,} users in {elapsed:.2f} s "
+          f"({len(graph) / elapsed:,.0f} users/s, {suggested:,} suggestions)")
+    return elapsed
+
+
+def bench_sql(user_ids, edges, size, sample):
+    connection = sqlite3.connect(':memory:')
+    connection.execute("CREATE TABLE follows (user_being_followed_id INTEGER, "
+                       "user_following_id INTEGER, PRIMARY KEY "
+                       "(user_being_followed_id, user_following_id))")
+    connection.execute("CREATE INDEX ix_follows_following ON follows "
+                       "(user_following_id, user_being_followed_id)")
+    connection.executemany(
+        "INSERT INTO follows (user_following_id, user_being_followed_id) "
+        "VALUES (?, ?)", edges)
+
+    timings = []
+    for user_id in random.Random(1).sample(user_ids, sample):
+        start = time.perf_counter()
+        connection.execute(FRIENDS_OF_FRIENDS_SQL,
+                           {'user_id': user_id, 'limit': size}).fetchall()
+        timings.append(time.perf_counter() - start)
+
+    mean = statistics.mean(timings)
+    print(f"SQLite self-join: {mean * 1000:.2f} ms/user over {sample} users, "
+          f"about {mean * len(user_ids):,.0f} s for all {len(user_ids):,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--edges', type=int, default=1_000_000)
+    parser.add_argument('--size', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--sql-sample', type=int, default=200)
+    parser.add_argument('--no-numpy', action='store_true')
+    args = parser.parse_args()
+
+    import recommendations
+    if args.no_numpy:
+        recommendations.np = None
+    print("using numpy" if recommendations.np is not None
+          else "using pure Python")
+
+    user_ids = list(range(1, args.users + 1))
+    start = time.perf_counter()
+    edges = make_edges(args.users, args.edges)
+    print(f"generated {len(edges):,} follows in "
+          f"{time.perf_counter() - start:.1f} s")
+
+    bench_graph(user_ids, edges, args.size, args.batch_size)
+    if args.sql_sample:
+        bench_sql(user_ids, edges, args.size, args.sql_sample)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""Load test Warbler under gunicorn, once per worker model.
+
+Seeds a database (a temporary SQLite file unless --database is given; point
+it at an empty Postgres database for realistic numbers), then for each
+worker class starts `gunicorn app:app` with the production profile and
+gunicorn.conf.py, and drives it from --concurrency client threads for
+--duration seconds. Each client logs in as its own user and mixes GET /,
+GET /users/<id> and POST /message/<id>/like. Reports throughput, p50/p99
+latency and errors per worker model.
+
+    python benchmarks/loadtest.py --worker-classes sync,gthread --workers 2
+    python benchmarks/loadtest.py --database postgresql:///warbler_load
+"""
+
+import argparse
+import http.cookiejar
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def seed(users, messages_per_user, follows_per_user):
+    """Create users, messages and follows; return (user_ids, messages) with
+    messages as (id, author id) pairs."""
+
+    from app import app
+    from models import db, Follow, Message, User
+    import counters
+    import timelines
+
+    rng = random.Random(0)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        user_ids = []
+        for i in range(users):
+            user = User.signup(f"load{i}", f"load{i}@example.com", "password",
+                               None)
+            db.session.flush()
+            user_ids.append(user.id)
+            db.session.add_all(Message(text=f"load test message {n} by {i}",
+                                       user_id=user.id)
+                               for n in range(messages_per_user))
+
+        db.session.add_all(
+            Follow(user_following_id=follower, user_being_followed_id=followed)
+            for follower in user_ids
+            for followed in rng.sample(
+                [other for other in user_ids if other != follower],
+                min(follows_per_user, len(user_ids) - 1))
+        )
+        db.session.commit()
+
+        timelines.backfill()
+        counters.reconcile()
+
+        messages = db.session.execute(
+            db.select(Message.id, Message.user_id)).all()
+
+    return user_ids, [tuple(message) for message in messages]
+
+
+class Client:
+    """A logged-in browser session."""
+
+    def __init__(self, base_url, username):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+        page = self.request('GET', '/login')[1]
+        self.request('POST', '/login', {
+            'username': username,
+            'password': 'password',
+            'csrf_token': CSRF_RE.search(page).group(1),
+        })
+        self.csrf_token = CSRF_RE.search(self.request('GET', '/')[1]).group(1)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data else None
+        request = urllib.request.Request(
+            self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as error:
+            return error.code, ''
+
+
+def run_client(client, user_id, user_ids, messages, deadline, results):
+    rng = random.Random(user_id)
+    others = [message_id for message_id, author in messages
+              if author != user_id]
+
+    while time.monotonic() < deadline:
+        kind = rng.choices(('home', 'profile', 'like'), (5, 3, 2))[0]
+        if kind == 'home':
+            method, path, data = 'GET', '/', None
+        elif kind == 'profile':
+            method, path, data = 'GET', f'/users/{rng.choice(user_ids)}', None
+        else:
+            method, path, data = (
+                'POST', f'/message/{rng.choice(others)}/like',
+                {'url': '/', 'csrf_token': client.csrf_token})
+
+        start = time.perf_counter()
+        try:
+            status = client.request(method, path, data)[0]
+        except OSError:
+            status = None
+        results.append((kind, time.perf_counter() - start, status))
+
+
+def wait_for_port(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"gunicorn exited with status {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    sys.exit("gunicorn did not start")
+
+
+def report(worker_class, results, duration):
+    latencies = sorted(elapsed for _, elapsed, _ in results)
+    errors = sum(1 for _, _, status in results
+                 if status is None or status >= 400)
+    p50 = statistics.median(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{worker_class}: {len(results) / duration:.0f} req/s, "
+          f"p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms, "
+          f"{errors} errors of {len(results)}")
+
+    for kind in ('home', 'profile', 'like'):
+        timings = sorted(elapsed for k, elapsed, _ in results if k == kind)
+        if timings:
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+            print(f"  {kind}: {len(timings)} requests, "
+                  f"p99 {p99 * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--database')
+    parser.add_argument('--worker-classes', default='sync,gthread')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4,
+                        help="threads per gthread worker")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="client threads")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=20,
+                        help="messages per user")
+    parser.add_argument('--follows', type=int, default=10,
+                        help="follows per user")
+    args = parser.parse_args()
+
+    database = args.database or "sqlite:///" + os.path.join(
+        tempfile.mkdtemp(), "loadtest.sqlite")
+
+    env = dict(
+        os.environ,
+        DATABASE_URL=database,
+        SECRET_KEY=os.environ.get('SECRET_KEY', 'loadtest'),
+        BCRYPT_LOG_ROUNDS='4',
+        WARBLER_CONFIG='production',
+        WEB_CONCURRENCY=str(args.workers),
+        GUNICORN_THREADS=str(args.threads),
+        DB_POOL_SIZE=str(args.threads),
+        PORT=str(args.port),
+    )
+    os.environ.update(env)
+
+    user_ids, messages = seed(args.users, args.messages, args.follows)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    for worker_class in args.worker_classes.split(','):
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'app:app',
+             '--log-level', 'warning'],
+            cwd=ROOT,
+            env=dict(env, GUNICORN_WORKER_CLASS=worker_class),
+        )
+        try:
+            wait_for_port(args.port, process)
+
+            clients = [
+                (Client(base_url, f"load{i % len(user_ids)}"),
+                 user_ids[i % len(user_ids)])
+                for i in range(args.concurrency)
+            ]
+
+            results = []
+            deadline = time.monotonic() + args.duration
+            threads = [
+                threading.Thread(target=run_client, args=(
+                    client, user_id, user_ids, messages, deadline, results))
+                for client, user_id in clients
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            report(worker_class, results, args.duration)
+
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
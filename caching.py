@@ -0,0 +1,80 @@
+"""HTTP cache policy for Warbler pages.
+
+Responses are `no-store` unless the view opts in. A cacheable view computes
+a strong ETag from the row versions its page is built from (the viewer's
+`User.version`, the profile owner's, the ids of the messages or users listed
+and their authors' versions) by calling `not_modified(...)` before it
+renders.
+
+The viewer's version comes from their cached principal (see principal.py),
+which another worker's write leaves stale for up to USER_CACHE_TTL. So the
+parts that the viewer's likes and follows decide (which messages show as
+liked, which users as followed) are passed as the id sets read from the
+database, not trusted to that version. If the client already holds that representation it gets a 304 and
+the template is never rendered; otherwise the page is sent with the ETag and
+`Cache-Control: private, max-age=<PRIVATE_MAX_AGE>`.
+
+With the default PRIVATE_MAX_AGE of 0 browsers revalidate on every load,
+so a user always sees their own writes; raising it trades freshness for
+fewer requests.
+"""
+
+import hashlib
+import time
+
+from flask import current_app, g, request, session, Response
+
+
+def make_etag(parts):
+    """Strong ETag for a page described by `parts` (a tuple of scalars,
+    tuples and sets)."""
+
+    parts = tuple(sorted(part) if isinstance(part, (set, frozenset)) else part
+                  for part in parts)
+    return hashlib.blake2b(
+        repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _csrf_epoch():
+    # Pages embed signed CSRF tokens, which expire; start a new ETag before
+    # a cached copy's token can go stale
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return int(time.time() // (limit / 2)) if limit else 0
+
+
+def not_modified(*parts):
+    """Give the page being served an ETag derived from `parts`.
+
+    Returns a 304 response if the client's copy is current, None if the view
+    should render. Pages carrying one-off flash messages are never cached.
+    """
+
+    if session.get('_flashes'):
+        return None
+
+    viewer = (g.user.id, g.user.version) if g.user else None
+    etag = make_etag((request.full_path, viewer, _csrf_epoch()) + parts)
+    g.etag = etag
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304)
+
+    return None
+
+
+def apply_policy(response):
+    """Set caching headers on `response` (used as an after_request hook)."""
+
+    etag = g.pop('etag', None)
+
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = current_app.config['PRIVATE_MAX_AGE']
+        response.vary.add('Cookie')
+
+    elif 'Cache-Control' not in response.headers:
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+        response.cache_control.no_store = True
+
+    return response
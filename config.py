@@ -0,0 +1,115 @@
+"""Configuration profiles for Warbler.
+
+`create_app` takes one of the names in `PROFILES` (or a config class):
+
+- development: debug toolbar, permissive CORS, a fixed SECRET_KEY unless
+  one is set and background jobs on a thread in the web process; the default
+  for `flask run`.
+- testing: the warbler_test database, CSRF off, inline password hashing
+  and inline jobs.
+- production: no debug toolbar, CORS only for CORS_ORIGINS (if set), a
+  database connection pool sized from the environment, and jobs in the jobs
+  table for `flask run-jobs`. SECRET_KEY must be set; `create_app` refuses
+  to build the app without it.
+
+Settings are read from the environment (and .env) when this module is
+imported.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def database_url(default=None):
+    """DATABASE_URL, with Heroku's `postgres://` scheme fixed up for
+    SQLAlchemy."""
+
+    url = os.environ.get('DATABASE_URL', default)
+    return url and url.replace('postgres://', 'postgresql://', 1)
+
+
+def env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes')
+
+
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    SQLALCHEMY_DATABASE_URI = database_url()
+    SQLALCHEMY_ECHO = False
+
+    DEBUG_TOOLBAR = False
+    CORS_ORIGINS = os.environ.get('CORS_ORIGINS')
+
+    USE_MATERIALIZED_TIMELINES = env_bool('USE_MATERIALIZED_TIMELINES', True)
+    MESSAGES_PER_PAGE = 100
+    USERS_PER_PAGE = 50
+    SEARCH_RESULT_LIMIT = 200
+    BULK_FOLLOW_LIMIT = 50_000
+
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 8))
+    PASSWORD_HASH_STATS_INTERVAL = int(
+        os.environ.get('PASSWORD_HASH_STATS_INTERVAL', 300))
+
+    LOGIN_MAX_FAILURES_PER_USERNAME = 5
+    LOGIN_MAX_FAILURES_PER_IP = 50
+    LOGIN_THROTTLE_WINDOW = 300
+
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+    PRIVATE_MAX_AGE = int(os.environ.get('PRIVATE_MAX_AGE', 0))
+
+    PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', 1000))
+
+    TRENDING_HALF_LIFE = int(os.environ.get('TRENDING_HALF_LIFE', 21600))
+    TRENDING_SIZE = 50
+    TRENDING_PANEL_SIZE = 5
+
+    FOLLOW_GRAPH_INDEX = env_bool('FOLLOW_GRAPH_INDEX', False)
+
+    RECOMMENDATIONS_SIZE = 10
+    RECOMMENDATIONS_PANEL_SIZE = 5
+    RECOMMENDATIONS_REFRESH = int(
+        os.environ.get('RECOMMENDATIONS_REFRESH', 3600))
+
+    JOBS_MODE = os.environ.get('JOBS_MODE', 'queue')
+    JOBS_BATCH_SIZE = int(os.environ.get('JOBS_BATCH_SIZE', 100))
+    JOBS_MAX_ATTEMPTS = int(os.environ.get('JOBS_MAX_ATTEMPTS', 5))
+
+
+class DevelopmentConfig(Config):
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'development')
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+    CORS_ORIGINS = os.environ.get('CORS_ORIGINS', '*')
+    JOBS_MODE = os.environ.get('JOBS_MODE', 'thread')
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'testing')
+    SQLALCHEMY_DATABASE_URI = database_url('postgresql:///warbler_test')
+    WTF_CSRF_ENABLED = False
+    PASSWORD_HASH_WORKERS = 0
+    JOBS_MODE = 'inline'
+
+
+class ProductionConfig(Config):
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': env_bool('DB_POOL_PRE_PING', True),
+    }
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
@@ -0,0 +1,94 @@
+"""Denormalized per-user counters for Warbler.
+
+`User` carries `messages_count`, `following_count`, `followers_count` and
+`likes_count` so profile headers can be printed from a single row, and
+`Message` carries its own `likes_count`. The routes adjust them in the same
+transaction as the write they describe (likes via `Like.toggle`);
+`reconcile()` recomputes all of them from the base tables. Every counter
+change also bumps `User.version`, which page ETags are derived from.
+"""
+
+from sqlalchemy import func, select, update
+
+from models import db, Follow, Like, Message, User
+
+COUNTER_QUERIES = {
+    'messages_count': lambda: (
+        select(func.count())
+        .where(Message.user_id == User.id)),
+    'following_count': lambda: (
+        select(func.count())
+        .where(Follow.user_following_id == User.id)),
+    'followers_count': lambda: (
+        select(func.count())
+        .where(Follow.user_being_followed_id == User.id)),
+    'likes_count': lambda: (
+        select(func.count())
+        .where(Like.user_id == User.id)),
+}
+
+
+def _changes(deltas):
+    values = {
+        getattr(User, name): getattr(User, name) + delta
+        for name, delta in deltas.items()
+    }
+    values[User.version] = User.version + 1
+    return values
+
+
+def adjust(user_id, **deltas):
+    """Atomically add `deltas` (counter name -> change) to a user's counters."""
+
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(_changes(deltas))
+    )
+
+
+def adjust_many(user_ids, **deltas):
+    """Atomically add `deltas` to the counters of every user in `user_ids`."""
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values(_changes(deltas)),
+        execution_options={'synchronize_session': False},
+    )
+
+
+def remove_message(message):
+    """Update counters for `message`, which is about to be deleted along with
+    its likes."""
+
+    adjust(message.user_id, messages_count=-1)
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(
+            select(Like.user_id).where(Like.message_id == message.id)))
+        .values(_changes({'likes_count': -1}))
+    )
+
+
+def reconcile():
+    """Recompute every user's counters from the base tables."""
+
+    db.session.execute(
+        update(User).values({
+            User.version: User.version + 1,
+            **{getattr(User, name): query().scalar_subquery()
+               for name, query in COUNTER_QUERIES.items()},
+        }),
+        execution_options={'synchronize_session': False},
+    )
+
+    db.session.execute(
+        update(Message).values(likes_count=(
+            select(func.count())
+            .where(Like.message_id == Message.id)
+            .scalar_subquery())),
+        execution_options={'synchronize_session': False},
+    )
+    db.session.commit()
@@ -0,0 +1,70 @@
+"""Follow and unfollow as direct writes on the `follows` table.
+
+Nothing here loads a user's following/followers collections: follows are
+inserted (skipping existing rows) or deleted in batches, the counters are
+updated for exactly the rows that changed (with `User.graph_version`, which
+the follow graph index in graph.py checks), and jobs are enqueued to update
+the home timeline for them. This
+keeps a follow as cheap for someone following 50k accounts as for someone
+following five, and makes repeating a follow or unfollow harmless.
+"""
+
+import counters
+from jobs import job_runner
+from graph import graph_index
+from models import Follow
+from recommendations import recommender
+
+BATCH_SIZE = 1000
+
+
+def _batches(ids):
+    ids = list(dict.fromkeys(ids))
+    for start in range(0, len(ids), BATCH_SIZE):
+        yield ids[start:start + BATCH_SIZE]
+
+
+def follow(follower_id, followed_ids):
+    """Make `follower_id` follow `followed_ids`; returns the newly followed
+    ids. The caller commits."""
+
+    added = []
+
+    for batch in _batches(followed_ids):
+        new = Follow.add_many(follower_id, batch)
+        if new:
+            job_runner.enqueue(
+                'add_follows', follower_id=follower_id, followed_ids=new)
+            counters.adjust_many(new, followers_count=1, graph_version=1)
+            added.extend(new)
+
+    if added:
+        counters.adjust(follower_id, following_count=len(added),
+                        graph_version=1)
+        graph_index.record(follower_id, added, True)
+        recommender.schedule()
+
+    return added
+
+
+def unfollow(follower_id, followed_ids):
+    """Make `follower_id` stop following `followed_ids`; returns the ids that
+    were unfollowed. The caller commits."""
+
+    removed = []
+
+    for batch in _batches(followed_ids):
+        gone = Follow.remove_many(follower_id, batch)
+        if gone:
+            job_runner.enqueue(
+                'remove_follows', follower_id=follower_id, followed_ids=gone)
+            counters.adjust_many(gone, followers_count=-1, graph_version=1)
+            removed.extend(gone)
+
+    if removed:
+        counters.adjust(follower_id, following_count=-len(removed),
+                        graph_version=1)
+        graph_index.record(follower_id, removed, False)
+        recommender.schedule()
+
+    return removed
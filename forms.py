@@ -1,4 +1,7 @@
+from flask import current_app, g
 from flask_wtf import FlaskForm
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup, escape
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import InputRequired, Email, Length, URL, Optional
 
@@ -80,4 +83,26 @@ class LoginForm(FlaskForm):
     )
 
 class CSRFProtectForm(FlaskForm):
-    """Form just for CSRF Protection"""
\ No newline at end of file
+    """Form just for CSRF Protection"""
+
+
+def csrf_form():
+    """Return this request's CSRFProtectForm, constructing it on first use."""
+
+    if 'csrf_form' not in g:
+        g.csrf_form = CSRFProtectForm()
+    return g.csrf_form
+
+
+def csrf_field():
+    """Hidden CSRF token input for templates.
+
+    Rendered once per response; every form on the page reuses it.
+    """
+
+    if 'csrf_field' not in g:
+        name = current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+        g.csrf_field = Markup(
+            f'<input id="{name}" name="{name}" type="hidden" '
+            f'value="{escape(generate_csrf())}">')
+    return g.csrf_field
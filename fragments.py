@@ -0,0 +1,149 @@
+"""Rendered fragment cache for Warbler list pages.
+
+Timelines, profiles, likes and user lists render the same message items and
+user cards over and over. `message_items` and `user_cards` (template globals)
+reuse previously rendered HTML for each item, stamped with the
+`User.profile_version` it was rendered from (the author's for messages, the
+user's own for cards), and only render misses. Fragments show profile
+fields but no counters, so likes and follows, which bump `User.version`,
+leave them cached. They yield one item at a
+time, so streamed pages send items as they go.
+
+Cached fragments contain nothing viewer-specific: the like star and
+follow/unfollow button (with their CSRF token and return url) are rendered
+once per page per state and spliced into a placeholder after lookup.
+
+The backend is any object with `TTLCache`'s get/set/invalidate interface;
+by default a per-process LRU, but a client for a shared cache (memcached,
+Redis) can be passed to `init_app` so workers share their renders.
+"""
+
+from threading import Lock
+
+from flask import g, render_template
+from markupsafe import Markup
+
+from cache import TTLCache
+
+SLOT = Markup('<!--viewer-->')
+
+# Stands in for the item id in the per-page viewer forms. It's the first
+# thing in each form (in the action url), so it's replaced once per item.
+ITEM_ID = '0000'
+
+
+class FragmentCache:
+    """Version-stamped cache of rendered HTML fragments."""
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else TTLCache(4096, 3600)
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def init_app(self, app, backend=None):
+        """Configure from `app.config` and register the template globals."""
+
+        if backend is None:
+            backend = TTLCache(
+                app.config.setdefault('FRAGMENT_CACHE_SIZE', 4096),
+                app.config.setdefault('FRAGMENT_CACHE_TTL', 3600),
+            )
+        self.backend = backend
+
+        app.add_template_global(message_items)
+        app.add_template_global(user_cards)
+
+    def get(self, kind, item_id, version):
+        """Cached HTML for item (`kind`, `item_id`) if rendered at `version`,
+        else None."""
+
+        entry = self.backend.get((kind, item_id))
+        hit = entry is not None and entry[0] == version
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return entry[1] if hit else None
+
+    def set(self, kind, item_id, version, html):
+        self.backend.set((kind, item_id), (version, str(html)))
+
+    def invalidate(self, kind, *item_ids):
+        """Drop the fragments of items `item_ids`."""
+
+        self.backend.invalidate(*((kind, item_id) for item_id in item_ids))
+
+
+fragment_cache = FragmentCache()
+
+
+def invalidate_message(*message_ids):
+    fragment_cache.invalidate('message', *message_ids)
+
+
+def invalidate_user(*user_ids):
+    fragment_cache.invalidate('user', *user_ids)
+
+
+def _render_items(kind, items, version_of, template, slot_for):
+    for item in items:
+        version = version_of(item)
+        fragment = fragment_cache.get(kind, item.id, version)
+
+        if fragment is None:
+            fragment = render_template(template, **{kind: item, 'slot': SLOT})
+            fragment_cache.set(kind, item.id, version, fragment)
+
+        yield Markup(fragment.replace(SLOT, slot_for(item), 1))
+
+
+def message_items(messages, liked_ids):
+    """Yield the HTML of each message, with the viewer's like stars."""
+
+    forms = {
+        liked: render_template(
+            'fragments/like_form.html', message_id=ITEM_ID, liked=liked)
+        for liked in (False, True)
+    }
+
+    def slot_for(message):
+        if message.user_id == g.user.id:
+            return ''
+        return forms[message.id in liked_ids].replace(
+            ITEM_ID, str(message.id), 1)
+
+    yield from _render_items(
+        'message',
+        messages,
+        lambda message: message.user.profile_version,
+        'fragments/message.html',
+        slot_for,
+    )
+
+
+def user_cards(users, following_ids):
+    """Yield the HTML card of each user, with the viewer's follow buttons."""
+
+    forms = {
+        following: render_template(
+            'fragments/follow_form.html', user_id=ITEM_ID, following=following)
+        for following in (False, True)
+    }
+
+    def slot_for(user):
+        if not g.user:
+            return ''
+        return forms[user.id in following_ids].replace(
+            ITEM_ID, str(user.id), 1)
+
+    yield from _render_items(
+        'user',
+        users,
+        lambda user: user.profile_version,
+        'fragments/user_card.html',
+        slot_for,
+    )
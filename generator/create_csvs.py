@@ -10,7 +10,6 @@ from dotenv import load_dotenv
 
 import csv
 from random import choice, randint, sample
-from itertools import permutations
 import requests
 from faker import Faker
 from helpers import get_random_datetime
@@ -24,10 +23,14 @@ MAX_WARBLER_LENGTH = 140
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id', 'timestamp']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# Override these to generate larger data sets for performance testing;
+# seed.py streams files of any size
+NUM_USERS = int(os.environ.get('NUM_USERS', 300))
+NUM_MESSAGES = int(os.environ.get('NUM_MESSAGES', 1000))
+NUM_FOLLWERS = int(os.environ.get('NUM_FOLLOWS', 5000))
+NUM_LIKES = int(os.environ.get('NUM_LIKES', 5000))
 
 fake = Faker()
 
@@ -70,20 +73,49 @@ with open('generator/messages.csv', 'w') as messages_csv:
     messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
     messages_writer.writeheader()
 
+    authors = []
+    posted = []
+
     for i in range(NUM_MESSAGES):
+        authors.append(randint(1, NUM_USERS))
+        posted.append(get_random_datetime())
         messages_writer.writerow(dict(
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+            timestamp=posted[-1],
+            user_id=authors[-1]
         ))
 
 # Generate follows.csv from random pairings of users
 
 with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
     users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
     users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
+    # Sample pairs without materializing all NUM_USERS ** 2 of them
+    follows = set()
+    while len(follows) < NUM_FOLLWERS:
+        followed_user, follower = sample(range(1, NUM_USERS + 1), 2)
+        follows.add((followed_user, follower))
+
+    for followed_user, follower in follows:
         users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+# Generate likes.csv from random users and messages, skipping users' own,
+# each liked some time after the message was posted
+
+with open('generator/likes.csv', 'w') as likes_csv:
+    likes_writer = csv.DictWriter(likes_csv, fieldnames=LIKES_CSV_HEADERS)
+    likes_writer.writeheader()
+
+    likes = set()
+    while len(likes) < NUM_LIKES:
+        user_id, message_id = randint(1, NUM_USERS), randint(1, NUM_MESSAGES)
+        if authors[message_id - 1] != user_id:
+            likes.add((user_id, message_id))
+
+    for user_id, message_id in likes:
+        likes_writer.writerow(dict(
+            user_id=user_id,
+            message_id=message_id,
+            timestamp=get_random_datetime(after=posted[message_id - 1])
+        ))
@@ -4,11 +4,11 @@ from datetime import datetime
 from random import uniform
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, after=None):
+    """Get a random datetime within the last few years, or since `after`."""
 
     now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
+    then = after or now.replace(year=now.year - year_gap)
     random_timestamp = uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
@@ -0,0 +1,317 @@
+"""Process-local index of the follow graph for Warbler.
+
+With FOLLOW_GRAPH_INDEX on, "does A follow B?", "who does A follow?" and
+"how many followers does B have?" are answered from memory instead of from
+`follows`. Each worker builds the index on first use (gunicorn.conf.py
+builds it as the worker starts) as two adjacency arrays in compressed sparse
+row form, one per direction, indexed directly by user id: the users
+followed by user u are `following[offsets[u]:offsets[u + 1]]`, sorted, so
+membership is a binary search. That is 4 bytes per edge per direction plus
+20 bytes per user id (offsets for both directions and a version);
+`stats()` reports the total per million edges.
+
+Every follow change bumps `User.graph_version` for both users (see
+follows.py). Lookups check the version the index holds for a user against
+the one in the user's cached principal (see principal.py) and reload just
+that user's lists when they differ, so changes made by other workers show
+up within USER_CACHE_TTL. Changes made in this process are applied as soon
+as their transaction commits: `record` queues them, and the entries they
+touch move out of the arrays into a small per-user overlay.
+"""
+
+import logging
+import os
+import time
+from array import array
+from bisect import bisect_left, insort
+from threading import Lock
+
+from sqlalchemy import event, func, select
+
+from models import db, Follow, User
+from principal import load_principal, user_cache
+
+logger = logging.getLogger(__name__)
+
+
+def _remove(values, value):
+    index = bisect_left(values, value)
+    if index < len(values) and values[index] == value:
+        del values[index]
+
+
+class GraphIndex:
+    """Sorted adjacency arrays for both directions of `follows`."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = Lock()
+        self._reset()
+
+    def init_app(self, app):
+        """Configure from `app.config`."""
+
+        self.enabled = app.config.setdefault('FOLLOW_GRAPH_INDEX', False)
+        self._reset()
+
+    def _reset(self):
+        self._pid = None
+        self._versions = array('i')
+        self._following_offsets = array('q', [0])
+        self._following = array('i')
+        self._followers_offsets = array('q', [0])
+        self._followers = array('i')
+        # user id -> [graph_version, following, followers] for users whose
+        # lists changed (or were reloaded) since the arrays were built
+        self._changed = {}
+
+    # Building
+
+    def build(self):
+        """(Re)build the index from the database."""
+
+        start = time.perf_counter()
+        size = (db.session.scalar(select(func.max(User.id))) or 0) + 1
+
+        # Versions first: an edge that lands after this read comes with a
+        # newer version, so the user is reloaded rather than missed
+        versions = array('i', bytes(4 * size))
+        for user_id, version in db.session.execute(
+                select(User.id, User.graph_version)
+                .where(User.deleted_at.is_(None))):
+            versions[user_id] = version
+
+        following_offsets = array('q', bytes(8 * (size + 1)))
+        following = array('i')
+        followers_offsets = array('q', bytes(8 * (size + 1)))
+
+        for follower_id, followed_id in db.session.execute(
+                select(Follow.user_following_id, Follow.user_being_followed_id)
+                .order_by(Follow.user_following_id,
+                          Follow.user_being_followed_id)
+                .execution_options(yield_per=50_000)):
+            if follower_id < size and followed_id < size:
+                following.append(followed_id)
+                following_offsets[follower_id + 1] += 1
+                followers_offsets[followed_id + 1] += 1
+
+        for user_id in range(size):
+            following_offsets[user_id + 1] += following_offsets[user_id]
+            followers_offsets[user_id + 1] += followers_offsets[user_id]
+
+        # Fill each user's followers in follower order, so they come out
+        # sorted
+        followers = array('i', bytes(4 * len(following)))
+        cursor = array('q', followers_offsets)
+        for follower_id in range(size):
+            for position in range(following_offsets[follower_id],
+                                  following_offsets[follower_id + 1]):
+                followed_id = following[position]
+                followers[cursor[followed_id]] = follower_id
+                cursor[followed_id] += 1
+
+        with self._lock:
+            self._versions = versions
+            self._following_offsets = following_offsets
+            self._following = following
+            self._followers_offsets = followers_offsets
+            self._followers = followers
+            self._changed = {}
+            self._pid = os.getpid()
+
+        stats = self.stats()
+        logger.info("built follow graph index of %d follows in %.2fs "
+                    "(%.1f MiB per million follows)", stats['edges'],
+                    time.perf_counter() - start,
+                    stats['bytes_per_million_edges'] / 2**20)
+
+    def _ensure_built(self):
+        # An index inherited over fork isn't kept current by this process's
+        # writes, so each worker builds its own
+        if self._pid != os.getpid():
+            self.build()
+
+    # Lookups
+
+    def _base_version(self, user_id):
+        return self._versions[user_id] if user_id < len(self._versions) else 0
+
+    def _base(self, user_id):
+        """Return `user_id`'s (values, lo, hi) bounds in the following and
+        followers arrays."""
+
+        if user_id + 1 >= len(self._following_offsets):
+            return (self._following, 0, 0), (self._followers, 0, 0)
+
+        return (
+            (self._following, self._following_offsets[user_id],
+             self._following_offsets[user_id + 1]),
+            (self._followers, self._followers_offsets[user_id],
+             self._followers_offsets[user_id + 1]),
+        )
+
+    def _lists(self, user_id):
+        """Return (values, lo, hi) bounds of the users `user_id` follows and
+        is followed by, reloading them if the user's principal shows a newer
+        graph_version; None if there is no such user."""
+
+        self._ensure_built()
+
+        principal = load_principal(user_id, user_cache)
+        if principal is None:
+            return None
+
+        entry = self._changed.get(user_id)
+        stored = self._base_version(user_id) if entry is None else entry[0]
+        if stored != principal.graph_version:
+            entry = self._reload(user_id, principal.graph_version)
+
+        if entry is None:
+            return self._base(user_id)
+
+        _, following, followers = entry
+        return (following, 0, len(following)), (followers, 0, len(followers))
+
+    def _reload(self, user_id, version):
+        following = array('i', db.session.scalars(
+            select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == user_id)
+            .order_by(Follow.user_being_followed_id)))
+        followers = array('i', db.session.scalars(
+            select(Follow.user_following_id)
+            .where(Follow.user_being_followed_id == user_id)
+            .order_by(Follow.user_following_id)))
+
+        entry = [version, following, followers]
+        with self._lock:
+            self._changed[user_id] = entry
+        return entry
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        lists = self._lists(follower_id)
+        if lists is None:
+            return False
+
+        values, lo, hi = lists[0]
+        index = bisect_left(values, followed_id, lo, hi)
+        return index < hi and values[index] == followed_id
+
+    def followed_ids(self, follower_id, user_ids):
+        """Return the subset of `user_ids` that `follower_id` follows."""
+
+        lists = self._lists(follower_id)
+        if lists is None:
+            return set()
+
+        values, lo, hi = lists[0]
+        followed = set()
+        for user_id in set(user_ids):
+            index = bisect_left(values, user_id, lo, hi)
+            if index < hi and values[index] == user_id:
+                followed.add(user_id)
+        return followed
+
+    def following(self, user_id):
+        """Ids of the users `user_id` follows, ascending."""
+
+        lists = self._lists(user_id)
+        if lists is None:
+            return array('i')
+
+        values, lo, hi = lists[0]
+        return values[lo:hi]
+
+    def followers(self, user_id):
+        """Ids of the users following `user_id`, ascending."""
+
+        lists = self._lists(user_id)
+        if lists is None:
+            return array('i')
+
+        values, lo, hi = lists[1]
+        return values[lo:hi]
+
+    def follower_count(self, user_id):
+        lists = self._lists(user_id)
+        if lists is None:
+            return 0
+
+        _, lo, hi = lists[1]
+        return hi - lo
+
+    def following_count(self, user_id):
+        lists = self._lists(user_id)
+        if lists is None:
+            return 0
+
+        _, lo, hi = lists[0]
+        return hi - lo
+
+    # Keeping current
+
+    def record(self, follower_id, followed_ids, followed):
+        """Apply `follower_id` following (or, with `followed` False,
+        unfollowing) `followed_ids` once the current transaction commits.
+        follows.py bumps each user's graph_version once per call."""
+
+        if self.enabled and followed_ids:
+            db.session.info.setdefault('graph_changes', []).append(
+                (follower_id, list(followed_ids), followed))
+
+    def _overlay(self, user_id):
+        entry = self._changed.get(user_id)
+        if entry is None:
+            (following, lo, hi), (followers, f_lo, f_hi) = self._base(user_id)
+            entry = [self._base_version(user_id), following[lo:hi],
+                     followers[f_lo:f_hi]]
+            self._changed[user_id] = entry
+        return entry
+
+    def _after_commit(self, session):
+        changes = session.info.pop('graph_changes', None)
+        if not changes or self._pid != os.getpid():
+            return
+
+        with self._lock:
+            for follower_id, followed_ids, followed in changes:
+                change = insort if followed else _remove
+                entry = self._overlay(follower_id)
+                for followed_id in followed_ids:
+                    other = self._overlay(followed_id)
+                    change(entry[1], followed_id)
+                    change(other[2], follower_id)
+                    # If another process changed either user meanwhile,
+                    # the versions still won't match and they're reloaded
+                    other[0] += 1
+                entry[0] += 1
+
+    def _after_rollback(self, session):
+        session.info.pop('graph_changes', None)
+
+    def stats(self):
+        """Return the number of users and edges indexed, the bytes of array
+        storage they take, and that per million edges."""
+
+        arrays = [self._versions, self._following_offsets, self._following,
+                  self._followers_offsets, self._followers]
+        arrays.extend(values for _, following, followers in
+                      list(self._changed.values())
+                      for values in (following, followers))
+        size = sum(len(values) * values.itemsize for values in arrays)
+        edges = len(self._following)
+
+        return {
+            'users': len(self._versions),
+            'edges': edges,
+            'changed_users': len(self._changed),
+            'bytes': size,
+            'bytes_per_million_edges': size * 1_000_000 / max(edges, 1),
+        }
+
+
+graph_index = GraphIndex()
+
+event.listen(db.session, 'after_commit', graph_index._after_commit)
+event.listen(db.session, 'after_rollback', graph_index._after_rollback)
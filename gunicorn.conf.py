@@ -0,0 +1,63 @@
+"""Gunicorn settings for Warbler; gunicorn reads this file from the working
+directory, so the Procfile only names the app.
+
+Pick the worker model with GUNICORN_WORKER_CLASS and size the database pool
+(DB_POOL_SIZE / DB_MAX_OVERFLOW, see config.py) to match. Every worker
+process has its own pool, so the database sees up to
+WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections; keep that
+under Postgres' max_connections.
+
+- sync (default): one request at a time per worker. A pool of 1 with no
+  overflow is enough; scale with WEB_CONCURRENCY.
+- gthread: GUNICORN_THREADS requests per worker. Set DB_POOL_SIZE to the
+  thread count so threads never wait on the pool.
+- gevent: up to GUNICORN_WORKER_CONNECTIONS greenlets per worker. Needs
+  gevent, and psycogreen so psycopg2 yields while waiting on Postgres. The
+  pool caps concurrent queries per worker; DB_POOL_TIMEOUT bounds how long
+  a greenlet waits for a connection. The app is loaded after the worker
+  has monkey-patched, not preloaded.
+
+With preloading, the app is imported once in the master and forked;
+models.connect_db drops the inherited connection pools in each child, and
+the password hashing pool is started per worker on first use. With
+FOLLOW_GRAPH_INDEX on, each worker builds its follow graph index before it
+takes requests.
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+preload_app = worker_class != 'gevent'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+
+def post_fork(server, worker):
+    if worker_class != 'gevent':
+        return
+
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        server.log.warning(
+            "psycogreen is not installed; database calls will block the "
+            "gevent worker")
+    else:
+        patch_psycopg()
+
+
+def post_worker_init(worker):
+    from graph import graph_index
+
+    if graph_index.enabled:
+        with worker.wsgi.app_context():
+            graph_index.build()
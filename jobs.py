@@ -0,0 +1,363 @@
+"""Deferred work for Warbler.
+
+Work that doesn't have to finish before the response (fanning messages out
+to timelines, rebuilding timelines after follow changes, purging deleted
+accounts) is registered as a handler and enqueued from the route:
+
+    @handler('fan_out_messages', batch=True)
+    def fan_out(payloads): ...
+
+    job_runner.enqueue('fan_out_messages', key=f'fan-out:{msg.id}',
+                       message_id=msg.id)
+    db.session.commit()
+
+Jobs only run once the request's transaction commits, and are dropped if it
+rolls back. `run_at` (a naive UTC datetime) holds a job back until then,
+except in inline mode. `key` is an idempotency key: a job whose key has
+already been enqueued, by a transaction that committed, is skipped. Batch
+handlers receive a list of payloads, others one payload as keyword arguments.
+
+Handlers don't commit; the runner commits after each handler call, so a
+handler's writes land together. The exception is 'purge_user' (purge.py),
+which commits after every batch so that no transaction holds a large
+account's locks for long. In inline mode that commits the enqueueing
+request's transaction along with the first batch, so it is enqueued last,
+once the rest of the request's writes are done.
+
+JOBS_MODE picks where jobs run:
+
+- queue: rows in the `jobs` table, written in the request's transaction and
+  run by `flask run-jobs`, which claims them in batches (with SKIP LOCKED on
+  PostgreSQL, so several workers can share the table). Failed jobs are
+  retried with exponential backoff up to JOBS_MAX_ATTEMPTS times, then left
+  as 'failed'; jobs held by a worker that died are reclaimed after
+  JOBS_LOCK_TIMEOUT seconds. Finished jobs are kept for JOBS_RETENTION
+  seconds, which is how long their keys are remembered.
+- thread: an in-memory queue drained by a background thread in each web
+  process, with the same batching and retries. Nothing survives a restart.
+- inline: run immediately, in the request's own transaction (see above for
+  'purge_user').
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from flask import current_app
+from sqlalchemy import and_, delete, event, or_, select, update
+
+from cache import TTLCache
+from models import db, insert_ignore, Job
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+def handler(kind, batch=False):
+    """Register the decorated function as the handler for jobs of `kind`."""
+
+    def register(fn):
+        HANDLERS[kind] = (fn, batch)
+        return fn
+
+    return register
+
+
+class JobRunner:
+    """Enqueues jobs and runs them in the configured JOBS_MODE."""
+
+    def __init__(self, mode='inline', batch_size=100, max_attempts=5,
+                 retry_delay=1.0, lock_timeout=300, retention=86400):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock_timeout = lock_timeout
+        self.retention = retention
+        self._keys = TTLCache(maxsize=10_000, ttl=retention)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Configure from `app.config`."""
+
+        self.mode = app.config.setdefault('JOBS_MODE', 'queue')
+        self.batch_size = app.config.setdefault('JOBS_BATCH_SIZE', 100)
+        self.max_attempts = app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+        self.retry_delay = app.config.setdefault('JOBS_RETRY_DELAY', 1.0)
+        self.lock_timeout = app.config.setdefault('JOBS_LOCK_TIMEOUT', 300)
+        self.retention = app.config.setdefault('JOBS_RETENTION', 86400)
+        self._keys = TTLCache(maxsize=10_000, ttl=self.retention)
+
+    # Enqueueing
+
+    def enqueue(self, kind, key=None, run_at=None, **payload):
+        """Run a `kind` job with `payload` once the current transaction
+        commits, and not before `run_at` if given; the caller commits."""
+
+        if kind not in HANDLERS:
+            raise KeyError(f"no handler for job kind {kind!r}")
+
+        if self.mode == 'queue':
+            db.session.execute(
+                insert_ignore(Job).values(
+                    kind=kind,
+                    payload=payload,
+                    idempotency_key=key,
+                    max_attempts=self.max_attempts,
+                    run_at=run_at or datetime.utcnow(),
+                )
+            )
+            return
+
+        # Begin the transaction now so a rollback is seen even if nothing
+        # else runs in it
+        db.session.connection()
+
+        if key is not None:
+            # Remembered only once the transaction commits, so a request
+            # that rolls back can be retried
+            keys = db.session.info.setdefault('job_keys', set())
+            if key in keys or self._keys.get(key):
+                return
+            keys.add(key)
+
+        if self.mode == 'inline':
+            self._call(kind, [payload])
+        else:
+            db.session.info.setdefault('jobs', []).append(
+                (kind, payload, run_at))
+
+    def _after_commit(self, session):
+        for key in session.info.pop('job_keys', ()):
+            self._keys.set(key, True)
+
+        pending = session.info.pop('jobs', None)
+        if pending:
+            self._start_thread(current_app._get_current_object())
+            for kind, payload, run_at in pending:
+                delay = 0
+                if run_at is not None:
+                    delay = (run_at - datetime.utcnow()).total_seconds()
+
+                if delay > 0:
+                    timer = threading.Timer(
+                        delay, self._queue.put, [(kind, payload)])
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self._queue.put((kind, payload))
+
+    def _after_rollback(self, session):
+        session.info.pop('job_keys', None)
+        session.info.pop('jobs', None)
+
+    # Running
+
+    def _call(self, kind, payloads):
+        fn, batch = HANDLERS[kind]
+        if batch:
+            fn(payloads)
+        else:
+            for payload in payloads:
+                fn(**payload)
+
+    def _run(self, kind, payloads):
+        """Run one group of jobs and commit them."""
+
+        self._call(kind, payloads)
+        db.session.commit()
+
+    def _run_groups(self, jobs, succeeded, failed):
+        """Run `jobs` (dicts with 'kind' and 'payload'), batching runs of the
+        same kind; call `succeeded(job)` or `failed(job, error)` for each."""
+
+        for kind, group in groupby(jobs, key=itemgetter('kind')):
+            group = list(group)
+            try:
+                self._run(kind, [job['payload'] for job in group])
+            except Exception as error:
+                db.session.rollback()
+                if len(group) == 1:
+                    logger.exception("job %s failed", kind)
+                    failed(group[0], repr(error))
+                    continue
+
+                # Find the bad job(s) by running the batch one at a time
+                for job in group:
+                    try:
+                        self._run(kind, [job['payload']])
+                    except Exception as error:
+                        db.session.rollback()
+                        logger.exception("job %s failed", kind)
+                        failed(job, repr(error))
+                    else:
+                        succeeded(job)
+            else:
+                for job in group:
+                    succeeded(job)
+
+    def _backoff(self, attempts):
+        return self.retry_delay * 2 ** (attempts - 1)
+
+    # thread mode
+
+    def _start_thread(self, app):
+        # Threads don't survive fork, so each web worker starts its own
+        with self._lock:
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(
+                    target=self._drain, args=(app,), name='jobs', daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def _drain(self, app):
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            with app.app_context():
+                self._run_in_memory(
+                    [{'kind': kind, 'payload': payload, 'attempts': 1}
+                     for kind, payload in jobs])
+
+            for _ in jobs:
+                self._queue.task_done()
+
+    def _run_in_memory(self, jobs):
+        while jobs:
+            retry = []
+
+            def failed(job, error):
+                if job['attempts'] < self.max_attempts:
+                    retry.append(dict(job, attempts=job['attempts'] + 1))
+                else:
+                    logger.error("job %s gave up after %d attempts: %s",
+                                 job['kind'], job['attempts'], error)
+
+            self._run_groups(jobs, lambda job: None, failed)
+
+            if retry:
+                time.sleep(self._backoff(retry[0]['attempts'] - 1))
+            jobs = retry
+
+    def join(self):
+        """Wait until every job handed to the background thread has run."""
+
+        self._queue.join()
+
+    # queue mode
+
+    def _claim(self, limit):
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=self.lock_timeout)
+
+        jobs = [row._asdict() for row in db.session.execute(
+            select(Job.id, Job.kind, Job.payload, Job.attempts,
+                   Job.max_attempts)
+            .where(or_(
+                and_(Job.status == 'pending', Job.run_at <= now),
+                and_(Job.status == 'running', Job.locked_at < stale),
+            ))
+            .order_by(Job.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )]
+
+        if jobs:
+            db.session.execute(
+                update(Job)
+                .where(Job.id.in_([job['id'] for job in jobs]))
+                .values(status='running', locked_at=now,
+                        attempts=Job.attempts + 1)
+            )
+        db.session.commit()
+
+        for job in jobs:
+            job['attempts'] += 1
+        return jobs
+
+    def _succeeded(self, job):
+        db.session.execute(
+            update(Job)
+            .where(Job.id == job['id'])
+            .values(status='done', finished_at=datetime.utcnow(),
+                    locked_at=None)
+        )
+        db.session.commit()
+
+    def _failed(self, job, error):
+        values = {'last_error': error[:1000], 'locked_at': None}
+        if job['attempts'] < job['max_attempts']:
+            values.update(
+                status='pending',
+                run_at=datetime.utcnow() + timedelta(
+                    seconds=self._backoff(job['attempts'])))
+        else:
+            values.update(status='failed', finished_at=datetime.utcnow())
+
+        db.session.execute(update(Job).where(Job.id == job['id'])
+                           .values(values))
+        db.session.commit()
+
+    def run_pending(self, limit=None):
+        """Claim and run up to `limit` (default JOBS_BATCH_SIZE) due jobs
+        from the table; return how many were claimed."""
+
+        jobs = self._claim(limit or self.batch_size)
+        self._run_groups(jobs, self._succeeded, self._failed)
+        return len(jobs)
+
+    def prune(self):
+        """Delete finished jobs older than JOBS_RETENTION seconds."""
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+        db.session.execute(
+            delete(Job)
+            .where(Job.status == 'done')
+            .where(Job.finished_at < cutoff)
+        )
+        db.session.commit()
+
+    def work(self, poll_interval=1.0, once=False):
+        """Run jobs from the table until interrupted (or, with `once`, until
+        none are due). Returns the number of jobs run."""
+
+        total = 0
+        start = time.perf_counter()
+        last_prune = 0.0
+
+        while True:
+            claimed = self.run_pending()
+            total += claimed
+            if claimed:
+                logger.info("ran %d jobs (%.0f jobs/s)", total,
+                            total / (time.perf_counter() - start))
+                continue
+
+            if once:
+                return total
+
+            if time.monotonic() - last_prune > 60:
+                self.prune()
+                last_prune = time.monotonic()
+            time.sleep(poll_interval)
+
+
+job_runner = JobRunner()
+
+event.listen(db.session, 'after_commit', job_runner._after_commit)
+event.listen(db.session, 'after_rollback', job_runner._after_rollback)
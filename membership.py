@@ -0,0 +1,43 @@
+"""Batched viewer membership lookups for Warbler pages.
+
+A page of messages or users asks "has the viewer liked these?" / "does the
+viewer follow these?" once for the whole page. Each helper issues a single
+query against `likes` or `follows` and returns a set, so templates test
+membership in O(1) instead of scanning the viewer's relationships per item.
+With FOLLOW_GRAPH_INDEX on, follows are looked up in the in-process index
+(see graph.py) without a query.
+"""
+
+from graph import graph_index
+from models import db, Follow, Like
+
+
+def liked_ids(viewer_id, message_ids):
+    """Return the subset of `message_ids` that `viewer_id` has liked."""
+
+    message_ids = set(message_ids)
+    if not message_ids:
+        return set()
+
+    return set(db.session.scalars(
+        db.select(Like.message_id)
+        .where(Like.user_id == viewer_id)
+        .where(Like.message_id.in_(message_ids))
+    ))
+
+
+def followed_ids(viewer_id, user_ids):
+    """Return the subset of `user_ids` that `viewer_id` follows."""
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return set()
+
+    if graph_index.enabled:
+        return graph_index.followed_ids(viewer_id, user_ids)
+
+    return set(db.session.scalars(
+        db.select(Follow.user_being_followed_id)
+        .where(Follow.user_following_id == viewer_id)
+        .where(Follow.user_being_followed_id.in_(user_ids))
+    ))
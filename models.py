@@ -1,11 +1,16 @@
 """SQLAlchemy models for Warbler."""
 
+import os
+import weakref
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import REGCONFIG
+
+from passwords import hasher
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 DEFAULT_IMAGE_URL = (
@@ -18,6 +23,22 @@ DEFAULT_HEADER_IMAGE_URL = (
     "mat&fit=crop&w=2070&q=80")
 
 
+def upsert(model):
+    """INSERT into `model`'s table that supports ON CONFLICT clauses
+    (`on_conflict_do_nothing` / `on_conflict_do_update`)."""
+
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def insert_ignore(model):
+    """INSERT into `model`'s table that skips rows which would conflict with
+    an existing key (ON CONFLICT DO NOTHING)."""
+
+    return upsert(model).on_conflict_do_nothing()
+
+
 class Follow(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -35,6 +56,48 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def add_many(cls, follower_id, followed_ids):
+        """Make `follower_id` follow every existing user in `followed_ids`.
+
+        Rows that already exist, unknown or deleted ids and `follower_id`
+        itself are skipped. Returns the ids that were newly followed.
+        """
+
+        existing_users = (
+            db.select(User.id, db.literal(follower_id))
+            .where(User.id.in_(followed_ids))
+            .where(User.id != follower_id)
+            .where(User.deleted_at.is_(None))
+        )
+
+        return list(db.session.scalars(
+            insert_ignore(cls)
+            .from_select(
+                ['user_being_followed_id', 'user_following_id'],
+                existing_users)
+            .returning(cls.user_being_followed_id)
+        ))
+
+    @classmethod
+    def remove_many(cls, follower_id, followed_ids):
+        """Make `follower_id` stop following `followed_ids`.
+
+        Returns the ids that were actually unfollowed.
+        """
+
+        return list(db.session.scalars(
+            db.delete(cls)
+            .where(cls.user_following_id == follower_id)
+            .where(cls.user_being_followed_id.in_(followed_ids))
+            .returning(cls.user_being_followed_id)
+        ))
+
 
 class User(db.Model):
     """User in the system."""
@@ -87,6 +150,83 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counters, kept current by the routes (see counters.py)
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Bumped whenever anything shown on the user's pages changes: profile
+    # fields and counters (see caching.py)
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Bumped only when the profile is edited; rendered messages and user
+    # cards show no counters, so they're cached against this instead (see
+    # fragments.py)
+
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Bumped whenever the user follows, unfollows, gains or loses a
+    # follower; the in-process follow graph index checks it (see graph.py)
+
+    graph_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Who to follow: ids of suggested users, best first, written by the
+    # periodic batch in recommendations.py
+
+    recommended_ids = db.Column(
+        db.JSON,
+        nullable=True,
+    )
+
+    # Set when the account is deleted; the account is hidden from then on and
+    # its rows are removed in the background (see purge.py)
+
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
     messages = db.relationship('Message', backref="user")
 
     followers = db.relationship(
@@ -103,6 +243,17 @@ class User(db.Model):
         backref="user_liked"
     )
 
+    # Trigram indexes backing user search on PostgreSQL (see search.py)
+    __table_args__ = tuple(
+        db.Index(
+            f'ix_users_{column}_trgm',
+            column,
+            postgresql_using='gin',
+            postgresql_ops={column: 'gin_trgm_ops'},
+        ).ddl_if(dialect='postgresql')
+        for column in ('username', 'bio', 'location')
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
@@ -113,7 +264,7 @@ class User(db.Model):
         Hashes password and adds user to session.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -135,40 +286,56 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the stored hash was made with a different bcrypt cost than the one
+        configured, the password is rehashed; the caller commits it.
         """
 
-        user = cls.query.filter_by(username=username).one_or_none()
+        user = (cls.query
+                .filter_by(username=username, deleted_at=None)
+                .one_or_none())
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
+        else:
+            # Unknown usernames cost a full bcrypt check too
+            hasher.dummy_check(password)
 
         return False
 
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follow.query.filter_by(
+                user_being_followed_id=self.id,
+                user_following_id=other_user.id,
+            ).exists()
+        ).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follow.query.filter_by(
+                user_being_followed_id=other_user.id,
+                user_following_id=self.id,
+            ).exists()
+        ).scalar()
 
     def is_message_liked(self, displayed_message):
         """Is the displayed_message been liked?"""
 
-        user_liked_list = [
-            message for message in self.liked_messages if message == displayed_message
-        ]
-
-        return len(user_liked_list) == 1
-
+        return db.session.query(
+            Like.query.filter_by(
+                user_id=self.id,
+                message_id=displayed_message.id,
+            ).exists()
+        ).scalar()
 
 
 class Message(db.Model):
@@ -198,9 +365,35 @@ class Message(db.Model):
         nullable=False,
     )
 
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     # this is another way to write the db.relationsip if we didn't write it in the User class
     # user = db.relationship('User', backref="messages")
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp_id',
+                 'user_id', 'timestamp', 'id'),
+        db.Index('ix_messages_timestamp_id', 'timestamp', 'id'),
+    )
+
+
+# Full-text index backing message search on PostgreSQL (see search.py).
+# Queries must use the same expression for the planner to pick the index.
+MESSAGE_SEARCH_CONFIG = db.cast(db.literal('english'), REGCONFIG)
+
+MESSAGE_TSVECTOR = db.func.to_tsvector(MESSAGE_SEARCH_CONFIG, Message.text)
+
+db.Index(
+    'ix_messages_text_fts',
+    MESSAGE_TSVECTOR,
+    postgresql_using='gin',
+).ddl_if(dialect='postgresql')
+
 
 class Like(db.Model):
     """ A table to join users and messages"""
@@ -219,12 +412,287 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # When the like was made: the liked-messages page is ordered by it, and
+    # an unlike takes back exactly the trending score it added (trending.py)
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
+        # A user's likes, newest first, for keyset paging
+        db.Index('ix_likes_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    # One statement on PostgreSQL: remove the like if present, otherwise add
+    # it, and move both counters by the same amount. When a concurrent toggle
+    # added the like first, the insert conflicts: the like is there, so the
+    # message counts as liked, and nothing changed.
+    TOGGLE_SQL = db.text("""
+        WITH deleted AS (
+            DELETE FROM likes
+            WHERE user_id = :user_id AND message_id = :message_id
+            RETURNING timestamp
+        ), inserted AS (
+            INSERT INTO likes (user_id, message_id, timestamp)
+            SELECT :user_id, :message_id, :now
+            WHERE NOT EXISTS (SELECT 1 FROM deleted)
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        ), delta AS (
+            SELECT (SELECT count(*) FROM inserted)
+                 - (SELECT count(*) FROM deleted) AS change
+        ), liker AS (
+            UPDATE users SET likes_count = likes_count + delta.change,
+                             version = version + 1
+            FROM delta
+            WHERE users.id = :user_id AND delta.change != 0
+        )
+        UPDATE messages SET likes_count = likes_count + delta.change
+        FROM delta
+        WHERE messages.id = :message_id
+        RETURNING NOT EXISTS (SELECT 1 FROM deleted), delta.change != 0,
+                  messages.likes_count, (SELECT timestamp FROM deleted)
+    """)
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like the message if `user_id` hasn't yet, otherwise unlike it.
+
+        Updates the like counters of the user and the message in the same
+        transaction. Returns (liked, changed, message likes_count, when the
+        like being removed was made); the last is None when liking.
+        `changed` is False when a concurrent toggle stored the same like
+        first, which leaves it liked and the counters as they were.
+        """
+
+        if db.engine.dialect.name == 'postgresql':
+            return tuple(db.session.execute(
+                cls.TOGGLE_SQL,
+                {'user_id': user_id, 'message_id': message_id,
+                 'now': datetime.utcnow()},
+            ).one())
+
+        deleted = db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == user_id)
+            .where(cls.message_id == message_id)
+            .returning(cls.timestamp)
+        ).first()
+
+        change = -1
+        liked_at = None
+        if deleted:
+            liked_at = deleted.timestamp
+        else:
+            change = db.session.execute(
+                db.insert(cls)
+                .prefix_with('OR IGNORE')
+                .values(user_id=user_id, message_id=message_id)
+            ).rowcount
+
+        if change:
+            db.session.execute(
+                db.update(User)
+                .where(User.id == user_id)
+                .values(likes_count=User.likes_count + change,
+                        version=User.version + 1)
+            )
+        likes_count = db.session.execute(
+            db.update(Message)
+            .where(Message.id == message_id)
+            .values(likes_count=Message.likes_count + change)
+            .returning(Message.likes_count)
+        ).scalar_one()
+
+        return not deleted, change != 0, likes_count, liked_at
+
+    @classmethod
+    def backfill_timestamps(cls):
+        """Date likes stored before likes had timestamps from their message,
+        the earliest they can have been made. Returns how many were dated;
+        the caller commits."""
+
+        return db.session.execute(
+            db.update(cls)
+            .where(cls.timestamp.is_(None))
+            .values(timestamp=db.select(Message.timestamp)
+                    .where(Message.id == cls.message_id)
+                    .scalar_subquery()),
+            execution_options={'synchronize_session': False},
+        ).rowcount
+
+
+event.listen(
+    db.metadata,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+        dialect='postgresql'),
+)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Rows are written when messages are posted and when follows change, so the
+    home page can read a timeline with a single indexed range scan.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+
+class TrendingScore(db.Model):
+    """A message's time-weighted likes within one trending window.
+
+    Within a window, scores need no decaying to be compared, so the top of
+    a window is an index scan (see trending.py).
+    """
+
+    __tablename__ = 'trending_scores'
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_trending_scores_bucket_score', 'bucket', 'score'),
+    )
+
+
+class Job(db.Model):
+    """A unit of deferred work, run by `flask run-jobs` (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    # Enqueueing a job with a key that is already in the table is a no-op
+    idempotency_key = db.Column(
+        db.String(200),
+        nullable=True,
+        unique=True,
+    )
+
+    # pending -> running -> done, or back to pending to retry, or failed
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='pending',
+        server_default='pending',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    last_error = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+
+_connected_apps = weakref.WeakSet()
+
+
+def _dispose_engines_after_fork():
+    # A forked worker must not share pooled connections with its parent:
+    # drop the inherited pool (without closing the parent's sockets) so the
+    # worker opens its own connections on first use
+    for app in list(_connected_apps):
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
     You should call this in your Flask app.
+
+    No app context is pushed here: requests, CLI commands and the test
+    client push their own, and scripts use `with app.app_context():`.
+    Connection pools are per process; see `_dispose_engines_after_fork`.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
+    _connected_apps.add(app)
@@ -0,0 +1,105 @@
+"""Keyset (cursor) pagination for Warbler list pages.
+
+Pages are requested with `?before=<cursor>`, where the cursor holds the sort
+key of the last row on the previous page. Each page is a range read on an
+index starting just past that key, so page N costs the same as page 1.
+
+Message lists are ordered by (timestamp, id) and use `<timestamp>,<id>`
+cursors, as do a user's liked messages, ordered by when they were liked
+(like timestamp, message id); user lists are ordered by id and use `<id>` cursors; ranked search
+results are ordered by (rank, id) and use `<rank>,<id>` cursors.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import tuple_
+
+Page = namedtuple("Page", ["items", "next_cursor"])
+
+
+def message_cursor(message):
+    """Cursor pointing just past `message` in a (timestamp, id) ordering."""
+
+    return f"{message.timestamp.isoformat()},{message.id}"
+
+
+def like_cursor(liked_at, message_id):
+    """Cursor pointing just past a like in a (like timestamp, message id)
+    ordering; parsed by `parse_message_cursor`."""
+
+    return f"{liked_at.isoformat()},{message_id}"
+
+
+def parse_message_cursor(value):
+    """Parse a `<timestamp>,<id>` cursor; 400 if it is malformed."""
+
+    if not value:
+        return None
+
+    try:
+        timestamp, message_id = value.rsplit(",", 1)
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except ValueError:
+        abort(400)
+
+
+def user_cursor(user):
+    """Cursor pointing just past `user` in an id ordering."""
+
+    return str(user.id)
+
+
+def parse_user_cursor(value):
+    """Parse an `<id>` cursor; 400 if it is malformed."""
+
+    if not value:
+        return None
+
+    try:
+        return (int(value),)
+    except ValueError:
+        abort(400)
+
+
+def rank_cursor(rank, item_id):
+    """Cursor pointing just past a (rank, id) search result."""
+
+    return f"{rank!r},{item_id}"
+
+
+def parse_rank_cursor(value):
+    """Parse a `<rank>,<id>` cursor; 400 if it is malformed."""
+
+    if not value:
+        return None
+
+    try:
+        rank, item_id = value.rsplit(",", 1)
+        return float(rank), int(item_id)
+    except ValueError:
+        abort(400)
+
+
+def keyset_page(query, columns, before, per_page, make_cursor):
+    """Return one page of `query` in descending order of `columns`.
+
+    `before` is the parsed cursor (a tuple matching `columns`) or None for the
+    first page. One extra row is fetched to decide whether there is a next
+    page; `make_cursor` builds the cursor from the last row returned.
+    """
+
+    if before is not None:
+        query = query.filter(tuple_(*columns) < tuple_(*before))
+
+    rows = (query
+            .order_by(*[column.desc() for column in columns])
+            .limit(per_page + 1)
+            .all())
+
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        return Page(rows, make_cursor(rows[-1]))
+
+    return Page(rows, None)
@@ -0,0 +1,191 @@
+"""Password hashing service for Warbler.
+
+bcrypt is deliberately slow, so hashing on the request thread lets a burst of
+logins pin every web worker. `PasswordHasher` runs bcrypt in a small process
+pool instead and bounds the number of hashes waiting for it: when the queue
+is full, `HashingBusy` is raised and the app answers 503 rather than letting
+requests pile up.
+
+Configuration (read by `init_app`):
+
+- BCRYPT_LOG_ROUNDS: bcrypt cost factor for new hashes (default 12). Stored
+  hashes with a different cost are rehashed on the next successful login.
+- PASSWORD_HASH_WORKERS: size of the process pool; 0 hashes inline.
+- PASSWORD_HASH_QUEUE: most hash/check operations in flight per web worker.
+- PASSWORD_HASH_STATS_INTERVAL: seconds between INFO log lines with each
+  web worker's `stats()` (default 300; 0 turns them off).
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password, hashed)
+
+
+def hash_cost(hashed):
+    """Return the bcrypt cost factor a stored hash was made with."""
+
+    return int(hashed.split('$')[2])
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded process pool."""
+
+    def __init__(self, rounds=12, workers=2, max_pending=8, stats_interval=300,
+                 timer=time.monotonic):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self.stats_interval = stats_interval
+        self.timer = timer
+        self._stats_logged_at = timer()
+        self._pending = BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_pid = None
+        self._dummy = None
+        self._lock = Lock()
+        self._stats = {
+            'hashes': 0,
+            'checks': 0,
+            'rejected': 0,
+            'in_flight': 0,
+            'total_seconds': 0.0,
+            'max_seconds': 0.0,
+        }
+
+    def init_app(self, app):
+        """Configure from `app.config`."""
+
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        self.workers = app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        self.max_pending = app.config.setdefault('PASSWORD_HASH_QUEUE', 8)
+        self.stats_interval = app.config.setdefault(
+            'PASSWORD_HASH_STATS_INTERVAL', 300)
+        self._pending = BoundedSemaphore(self.max_pending)
+        self.shutdown()
+
+    def _executor(self):
+        # Pools don't survive fork, so each web worker builds its own
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def shutdown(self):
+        """Stop the worker pool (it is restarted on next use)."""
+
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def _run(self, kind, fn, *args):
+        if not self._pending.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            self._log_stats()
+            raise HashingBusy()
+
+        with self._lock:
+            self._stats['in_flight'] += 1
+            depth = self._stats['in_flight']
+
+        start = time.perf_counter()
+        try:
+            if self.workers:
+                return self._executor().submit(fn, *args).result()
+            return fn(*args)
+
+        finally:
+            elapsed = time.perf_counter() - start
+            self._pending.release()
+
+            with self._lock:
+                self._stats['in_flight'] -= 1
+                self._stats[kind] += 1
+                self._stats['total_seconds'] += elapsed
+                self._stats['max_seconds'] = max(
+                    self._stats['max_seconds'], elapsed)
+
+            logger.debug("password %s: %.0f ms (queue depth %d)",
+                         kind, elapsed * 1000, depth)
+            self._log_stats()
+
+    def _log_stats(self):
+        if not self.stats_interval:
+            return
+
+        now = self.timer()
+        with self._lock:
+            if now - self._stats_logged_at < self.stats_interval:
+                return
+            self._stats_logged_at = now
+
+        stats = self.stats()
+        logger.info("password hashing: %d hashes, %d checks, %d rejected, "
+                    "mean %.0f ms, max %.0f ms (queue limit %d)",
+                    stats['hashes'], stats['checks'], stats['rejected'],
+                    stats['mean_seconds'] * 1000, stats['max_seconds'] * 1000,
+                    stats['queue_limit'])
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(
+            'hashes', _hash, password.encode('utf-8'), self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match the stored bcrypt hash `hashed`?"""
+
+        return self._run(
+            'checks', _check, hashed.encode('utf-8'), password.encode('utf-8'))
+
+    def dummy_check(self, password):
+        """Spend the same work as `check` against a hash nobody has, so a
+        login for an unknown user costs as much as one for a real user.
+        Always returns False."""
+
+        dummy = self._dummy
+        if dummy is None or hash_cost(dummy) != self.rounds:
+            dummy = self._dummy = self.hash(os.urandom(16).hex())
+
+        self.check(dummy, password)
+        return False
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        return hash_cost(hashed) != self.rounds
+
+    def stats(self):
+        """Counters and latency figures for hashing so far."""
+
+        with self._lock:
+            stats = dict(self._stats)
+
+        operations = stats['hashes'] + stats['checks']
+        stats['mean_seconds'] = (
+            stats['total_seconds'] / operations if operations else 0.0)
+        stats['queue_limit'] = self.max_pending
+        return stats
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,62 @@
+"""Lightweight, cached representation of the logged-in user.
+
+Most requests only need a handful of the current user's columns to render
+the nav bar and home card. `load_principal` reads them from a bounded TTL
+cache (falling back to a single lean SELECT), so an authenticated request
+does not pay for a full ORM load. Routes that mutate the user load the
+entity explicitly.
+"""
+
+from collections import namedtuple
+
+from cache import TTLCache
+from models import db, User
+
+PRINCIPAL_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.messages_count,
+    User.following_count,
+    User.followers_count,
+    User.likes_count,
+    User.version,
+    User.graph_version,
+    User.recommended_ids,
+)
+
+UserPrincipal = namedtuple(
+    "UserPrincipal", [column.key for column in PRINCIPAL_COLUMNS])
+
+user_cache = TTLCache()
+
+
+def init_app(app):
+    """Size the principal cache from USER_CACHE_SIZE and USER_CACHE_TTL."""
+
+    user_cache.maxsize = app.config.setdefault('USER_CACHE_SIZE', 1024)
+    user_cache.ttl = app.config.setdefault('USER_CACHE_TTL', 30)
+    user_cache.clear()
+
+
+def load_principal(user_id, cache):
+    """Return the UserPrincipal for `user_id`, or None if no such user (or
+    the account has been deleted)."""
+
+    principal = cache.get(user_id)
+    if principal is not None:
+        return principal
+
+    row = db.session.execute(
+        db.select(*PRINCIPAL_COLUMNS)
+        .where(User.id == user_id)
+        .where(User.deleted_at.is_(None))
+    ).one_or_none()
+
+    if row is None:
+        return None
+
+    principal = UserPrincipal(*row)
+    cache.set(user_id, principal)
+    return principal
@@ -0,0 +1,224 @@
+"""Account deletion for Warbler.
+
+Deleting a user with a large graph in one transaction holds locks on
+thousands of rows and ties up a web worker for seconds. Instead,
+`soft_delete` only stamps `User.deleted_at`, which hides the account
+everywhere, and a 'purge_user' job (see jobs.py) runs `purge_user`, which
+removes its likes, follows, timeline entries and messages in batches of
+PURGE_BATCH_SIZE rows, each in its own short transaction, keeping the other
+users' counters in step as it goes. The user row itself goes last.
+
+Unlike other job handlers, `purge_user` commits as it goes, so in inline
+mode it also commits the transaction that enqueued it; `delete_user`
+enqueues it as its last write.
+
+Every batch re-selects what is left, so a purge that fails part-way simply
+picks up where it stopped when the job is retried; `flask purge-users`
+finishes any that ran out of retries.
+"""
+
+import logging
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, select, tuple_, update
+
+from jobs import handler
+from models import db, Follow, Like, Message, TimelineEntry, User
+import counters
+
+logger = logging.getLogger(__name__)
+
+
+def soft_delete(user_id):
+    """Hide `user_id` until it is purged; the caller commits."""
+
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(deleted_at=datetime.utcnow(), version=User.version + 1)
+    )
+
+
+def pending_user_ids():
+    """Ids of soft-deleted users that have not been purged yet."""
+
+    return db.session.scalars(
+        select(User.id).where(User.deleted_at.is_not(None)).order_by(User.id)
+    ).all()
+
+
+def _purge_timelines_of_messages(user_id, batch_size):
+    # First, so the user's messages drop off followers' home pages quickly
+    keys = db.session.execute(
+        select(TimelineEntry.user_id, TimelineEntry.message_id)
+        .join(Message, Message.id == TimelineEntry.message_id)
+        .where(Message.user_id == user_id)
+        .limit(batch_size)
+    ).all()
+    _delete_keys(TimelineEntry, keys)
+    return len(keys)
+
+
+def _purge_own_timeline(user_id, batch_size):
+    keys = db.session.execute(
+        select(TimelineEntry.user_id, TimelineEntry.message_id)
+        .where(TimelineEntry.user_id == user_id)
+        .limit(batch_size)
+    ).all()
+    _delete_keys(TimelineEntry, keys)
+    return len(keys)
+
+
+def _purge_likes_given(user_id, batch_size):
+    message_ids = db.session.scalars(
+        select(Like.message_id)
+        .where(Like.user_id == user_id)
+        .limit(batch_size)
+    ).all()
+    if message_ids:
+        db.session.execute(
+            update(Message)
+            .where(Message.id.in_(message_ids))
+            .values(likes_count=Message.likes_count - 1),
+            execution_options={'synchronize_session': False},
+        )
+        db.session.execute(
+            delete(Like)
+            .where(Like.user_id == user_id)
+            .where(Like.message_id.in_(message_ids))
+        )
+    return len(message_ids)
+
+
+def _purge_likes_received(user_id, batch_size):
+    keys = db.session.execute(
+        select(Like.user_id, Like.message_id)
+        .join(Message, Message.id == Like.message_id)
+        .where(Message.user_id == user_id)
+        .limit(batch_size)
+    ).all()
+
+    # A liker may appear several times in one batch
+    by_count = {}
+    for liker_id, count in Counter(liker for liker, _ in keys).items():
+        by_count.setdefault(count, []).append(liker_id)
+    for count, liker_ids in by_count.items():
+        counters.adjust_many(liker_ids, likes_count=-count)
+
+    _delete_keys(Like, keys)
+    return len(keys)
+
+
+def _purge_following(user_id, batch_size):
+    followed_ids = db.session.scalars(
+        select(Follow.user_being_followed_id)
+        .where(Follow.user_following_id == user_id)
+        .limit(batch_size)
+    ).all()
+    if followed_ids:
+        counters.adjust_many(followed_ids, followers_count=-1,
+                             graph_version=1)
+        db.session.execute(
+            delete(Follow)
+            .where(Follow.user_following_id == user_id)
+            .where(Follow.user_being_followed_id.in_(followed_ids))
+        )
+    return len(followed_ids)
+
+
+def _purge_followers(user_id, batch_size):
+    follower_ids = db.session.scalars(
+        select(Follow.user_following_id)
+        .where(Follow.user_being_followed_id == user_id)
+        .limit(batch_size)
+    ).all()
+    if follower_ids:
+        counters.adjust_many(follower_ids, following_count=-1,
+                             graph_version=1)
+        db.session.execute(
+            delete(Follow)
+            .where(Follow.user_being_followed_id == user_id)
+            .where(Follow.user_following_id.in_(follower_ids))
+        )
+    return len(follower_ids)
+
+
+def _purge_messages(user_id, batch_size):
+    message_ids = db.session.scalars(
+        select(Message.id)
+        .where(Message.user_id == user_id)
+        .limit(batch_size)
+    ).all()
+    if message_ids:
+        db.session.execute(
+            delete(Message).where(Message.id.in_(message_ids)),
+            execution_options={'synchronize_session': False},
+        )
+    return len(message_ids)
+
+
+def _delete_keys(model, keys):
+    if keys:
+        db.session.execute(
+            delete(model).where(
+                tuple_(model.user_id, model.message_id).in_(keys)),
+            execution_options={'synchronize_session': False},
+        )
+
+
+# In order: likes and timeline entries go before the messages they refer to
+PHASES = [
+    ('timelines', _purge_timelines_of_messages),
+    ('timelines', _purge_own_timeline),
+    ('likes', _purge_likes_given),
+    ('likes', _purge_likes_received),
+    ('follows', _purge_following),
+    ('follows', _purge_followers),
+    ('messages', _purge_messages),
+]
+
+
+def purge_user(user_id, batch_size=1000):
+    """Remove a soft-deleted user and everything that refers to them.
+
+    Returns a dict of rows removed per table, plus 'seconds' and
+    'rows_per_second'. Does nothing (and removes nothing) for users that
+    are not soft-deleted.
+    """
+
+    start = time.perf_counter()
+    removed = Counter()
+
+    if db.session.scalar(
+            select(User.deleted_at).where(User.id == user_id)) is None:
+        return {'seconds': 0.0, 'rows_per_second': 0.0}
+
+    for table, phase in PHASES:
+        while True:
+            count = phase(user_id, batch_size)
+            db.session.commit()
+            removed[table] += count
+            if count < batch_size:
+                break
+
+    db.session.execute(delete(User).where(User.id == user_id))
+    db.session.commit()
+    removed['users'] += 1
+
+    seconds = time.perf_counter() - start
+    total = sum(removed.values())
+    report = dict(removed, seconds=seconds,
+                  rows_per_second=total / max(seconds, 1e-9))
+
+    logger.info("purged user %d: %d rows in %.2fs (%.0f rows/s)",
+                user_id, total, seconds, report['rows_per_second'])
+    return report
+
+
+@handler('purge_user')
+def purge_user_job(user_id):
+    # Commits after each batch; see the module docstring
+    purge_user(user_id, current_app.config['PURGE_BATCH_SIZE'])
@@ -0,0 +1,57 @@
+"""Count the SQL statements a block of code sends to the database.
+
+Used by the view tests to pin the number of queries per page, so an N+1
+regression (e.g. a lazy load per message author) fails the suite.
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """Statements executed while the counter was active."""
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine):
+    """Context manager yielding a QueryCounter for statements on `engine`."""
+
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+
+
+class QueryCountMixin:
+    """TestCase mixin providing `assertMaxQueries`."""
+
+    @contextmanager
+    def assertMaxQueries(self, expected, engine=None):
+        """Fail if the block issues more than `expected` SQL statements."""
+
+        from models import db
+
+        with count_queries(engine or db.engine) as counter:
+            yield counter
+
+        self.assertLessEqual(
+            counter.count,
+            expected,
+            f"{counter.count} queries issued, expected at most {expected}:\n"
+            + "\n".join(counter.statements),
+        )
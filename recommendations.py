@@ -0,0 +1,296 @@
+"""Who-to-follow recommendations for Warbler.
+
+Suggesting friends of friends with a per-request self-join on `follows`
+costs a scan of every followee's followees on every page view. Instead,
+`recommender.recompute()` loads the whole follow graph into memory once as
+compressed sparse rows (CSR: one offsets array and one array of followee
+indices, both sorted), scores every user's candidates in batches of
+RECOMMENDATIONS_BATCH_SIZE users, and stores each user's top
+RECOMMENDATIONS_SIZE in `User.recommended_ids`.
+
+A candidate's score is the number of the user's followees who follow them;
+users already followed (and the user themself) are left out, and ties go to
+the lower id. With numpy installed each batch is scored with a handful of
+vectorized array operations; without it, one user at a time with Counter.
+
+Recommendations are recomputed at the end of every RECOMMENDATIONS_REFRESH
+second period in which follows changed: each follow or unfollow enqueues a
+'recompute_recommendations' job due at the end of the period (see jobs.py),
+keyed by that time so there is one per period, and the last change of the
+period is included. `flask recommend` runs one by hand (e.g. from a
+scheduler). A recompute reads the whole graph, so with JOBS_MODE=inline,
+which would run it inside the request, nothing is scheduled and `flask
+recommend` is the way to refresh. Only users whose recommendations changed
+are written.
+
+Pages read the stored ids from the cached principal (see principal.py), so
+users without recommendations cost nothing; for the rest, the suggested
+users (minus any followed since) are read once and cached per user and
+version for RECOMMENDATIONS_CACHE_TTL seconds.
+"""
+
+import heapq
+import logging
+import time
+from array import array
+from collections import Counter, namedtuple
+from datetime import datetime
+
+from sqlalchemy import exists, select, update
+
+from cache import TTLCache
+from jobs import handler, job_runner
+from models import db, Follow, User
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - optional speedup
+    np = None
+
+logger = logging.getLogger(__name__)
+
+SUGGESTION_COLUMNS = (
+    User.id,
+    User.username,
+)
+
+Suggestion = namedtuple(
+    'Suggestion', [column.key for column in SUGGESTION_COLUMNS])
+
+
+def _gather(indptr, indices, nodes):
+    """For each node in `nodes`, the positions (in `nodes`) and values of its
+    CSR row, concatenated."""
+
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    owners = np.repeat(np.arange(len(nodes)), lengths)
+    offsets = np.arange(len(owners)) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths)
+    return owners, indices[np.repeat(starts, lengths) + offsets]
+
+
+class FollowGraph:
+    """The follow graph as compressed sparse rows.
+
+    Users are numbered 0..n-1 in `user_ids` order; the users followed by
+    user i are indices[indptr[i]:indptr[i + 1]], in ascending order.
+    """
+
+    def __init__(self, user_ids, indptr, indices):
+        self.user_ids = user_ids
+        self.indptr = indptr
+        self.indices = indices
+
+        if np is not None:
+            self._np_user_ids = np.asarray(user_ids, dtype=np.int64)
+            self._np_indptr = np.frombuffer(indptr, dtype=np.int64)
+            self._np_indices = np.frombuffer(indices, dtype=np.int32)
+
+    @classmethod
+    def from_edges(cls, user_ids, edges):
+        """Build from ascending `user_ids` and (follower_id, followed_id)
+        pairs sorted by follower and then followed id. Edges to or from
+        users not in `user_ids` are skipped."""
+
+        index = {user_id: i for i, user_id in enumerate(user_ids)}
+        indptr = array('q', bytes(8 * (len(user_ids) + 1)))
+        indices = array('i')
+
+        for follower_id, followed_id in edges:
+            row = index.get(follower_id)
+            column = index.get(followed_id)
+            if row is not None and column is not None:
+                indices.append(column)
+                indptr[row + 1] += 1
+
+        for row in range(len(user_ids)):
+            indptr[row + 1] += indptr[row]
+
+        return cls(user_ids, indptr, indices)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @property
+    def edges(self):
+        return len(self.indices)
+
+    def recommend(self, rows, limit):
+        """Return the ids of the top `limit` candidates for each user index
+        in `rows`, best first."""
+
+        if np is not None:
+            return self._recommend_numpy(rows, limit)
+        return [self._recommend_one(row, limit) for row in rows]
+
+    def _recommend_one(self, row, limit):
+        indptr, indices = self.indptr, self.indices
+        followed = indices[indptr[row]:indptr[row + 1]]
+
+        counts = Counter()
+        for followee in followed:
+            counts.update(indices[indptr[followee]:indptr[followee + 1]])
+        counts.pop(row, None)
+        for followee in followed:
+            counts.pop(followee, None)
+
+        return [self.user_ids[candidate] for candidate, _ in heapq.nsmallest(
+            limit, counts.items(), key=lambda item: (-item[1], item[0]))]
+
+    def _recommend_numpy(self, rows, limit):
+        n = len(self.user_ids)
+        rows = np.asarray(rows, dtype=np.int64)
+
+        # Followees of each row, then their followees, keyed by row and
+        # candidate as one integer so a single unique() counts them all
+        owners, followed = _gather(self._np_indptr, self._np_indices, rows)
+        hops, candidates = _gather(self._np_indptr, self._np_indices,
+                                   followed.astype(np.int64))
+        keys, counts = np.unique(owners[hops] * n + candidates,
+                                 return_counts=True)
+
+        # Drop each row itself and the users it already follows
+        excluded = np.sort(np.concatenate((np.arange(len(rows)) * n + rows,
+                                           owners * n + followed)))
+        found = np.searchsorted(excluded, keys)
+        keep = excluded[np.minimum(found, len(excluded) - 1)] != keys
+        keys, counts = keys[keep], counts[keep]
+        owners, candidates = np.divmod(keys, n)
+
+        # Best first within each row; unique() sorted candidates within a
+        # row, and a stable sort keeps that order among equal counts
+        most = counts.max(initial=0)
+        order = np.argsort(owners * (most + 1) + (most - counts),
+                           kind='stable')
+        owners, candidates = owners[order], candidates[order]
+        ranks = np.arange(len(owners)) - np.searchsorted(owners, owners)
+        keep = ranks < limit
+
+        results = [[] for _ in range(len(rows))]
+        for owner, user_id in zip(
+                owners[keep].tolist(),
+                self._np_user_ids[candidates[keep]].tolist()):
+            results[owner].append(user_id)
+        return results
+
+
+class Recommender:
+    """Computes, stores and serves who-to-follow suggestions."""
+
+    def __init__(self, size=10, batch_size=1000, refresh=3600, cache_ttl=300,
+                 timer=time.time):
+        self.size = size
+        self.batch_size = batch_size
+        self.refresh = refresh
+        self.timer = timer
+        self.cache = TTLCache(maxsize=1024, ttl=cache_ttl)
+
+    def init_app(self, app):
+        """Configure from `app.config`."""
+
+        self.size = app.config.setdefault('RECOMMENDATIONS_SIZE', 10)
+        self.batch_size = app.config.setdefault(
+            'RECOMMENDATIONS_BATCH_SIZE', 1000)
+        self.refresh = app.config.setdefault('RECOMMENDATIONS_REFRESH', 3600)
+        self.cache = TTLCache(
+            maxsize=app.config.setdefault('USER_CACHE_SIZE', 1024),
+            ttl=app.config.setdefault('RECOMMENDATIONS_CACHE_TTL', 300))
+
+    def schedule(self):
+        """Recompute at the end of the current period, so the follow graph
+        as it is then, including this change, is picked up. The caller
+        commits.
+
+        Inline jobs would recompute inside the request, so with
+        JOBS_MODE=inline nothing is scheduled; run `flask recommend`.
+        """
+
+        if job_runner.mode == 'inline':
+            return
+
+        end = (int(self.timer() // self.refresh) + 1) * self.refresh
+        job_runner.enqueue('recompute_recommendations',
+                           key=f'recommendations:{end}',
+                           run_at=datetime.utcfromtimestamp(end))
+
+    def recompute(self):
+        """Recompute and store every user's recommendations; the caller
+        commits. Returns a dict of counts and timings."""
+
+        start = time.perf_counter()
+
+        current = dict(db.session.execute(
+            select(User.id, User.recommended_ids)
+            .where(User.deleted_at.is_(None))
+            .order_by(User.id)
+        ).all())
+        graph = FollowGraph.from_edges(
+            list(current),
+            db.session.execute(
+                select(Follow.user_following_id, Follow.user_being_followed_id)
+                .order_by(Follow.user_following_id,
+                          Follow.user_being_followed_id)
+                .execution_options(yield_per=50_000)
+            ),
+        )
+        loaded = time.perf_counter()
+
+        changed = []
+        for first in range(0, len(graph), self.batch_size):
+            rows = range(first, min(first + self.batch_size, len(graph)))
+            for row, ids in zip(rows, graph.recommend(rows, self.size)):
+                user_id = graph.user_ids[row]
+                if (current[user_id] or []) != ids:
+                    changed.append({'id': user_id, 'recommended_ids': ids})
+        scored = time.perf_counter()
+
+        for first in range(0, len(changed), self.batch_size):
+            db.session.execute(
+                update(User), changed[first:first + self.batch_size])
+        self.cache.clear()
+
+        report = {
+            'users': len(graph),
+            'edges': graph.edges,
+            'changed': len(changed),
+            'load_seconds': loaded - start,
+            'score_seconds': scored - loaded,
+            'seconds': time.perf_counter() - start,
+        }
+        logger.info("recommendations for %d users over %d follows in %.2fs "
+                    "(%d changed)", report['users'], report['edges'],
+                    report['seconds'], report['changed'])
+        return report
+
+    def for_user(self, principal, limit):
+        """Return up to `limit` Suggestions for the user `principal`, best
+        first."""
+
+        ids = principal.recommended_ids
+        if not ids or not limit:
+            return []
+
+        key = (principal.id, principal.version, tuple(ids))
+        suggestions = self.cache.get(key)
+        if suggestions is None:
+            found = {row.id: Suggestion(*row) for row in db.session.execute(
+                select(*SUGGESTION_COLUMNS)
+                .where(User.id.in_(ids))
+                .where(User.deleted_at.is_(None))
+                .where(~exists()
+                       .where(Follow.user_following_id == principal.id)
+                       .where(Follow.user_being_followed_id == User.id))
+            )}
+            suggestions = [found[id] for id in ids if id in found]
+            self.cache.set(key, suggestions)
+
+        return suggestions[:limit]
+
+
+recommender = Recommender()
+
+
+@handler('recompute_recommendations')
+def recompute_recommendations():
+    recommender.recompute()
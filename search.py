@@ -0,0 +1,412 @@
+"""Indexed search for Warbler users and messages.
+
+On PostgreSQL, user search runs against GIN trigram (pg_trgm) indexes on
+username, bio and location and is ranked by trigram similarity. Other
+databases (SQLite in tests and local development) use an in-process trigram
+index with the same matching and ranking rules, loaded from the `users`
+table on first use and kept current by the signup/profile/delete routes.
+
+A user matches when the query appears (case-insensitively) in any of the
+indexed fields; username similarity counts fully towards the rank, bio and
+location similarity count half.
+
+Message search uses the GIN full-text index on `to_tsvector(text)` on
+PostgreSQL, ranked by ts_rank; elsewhere an in-process inverted index with
+a tf-idf style rank stands in. Every query term must match. Results are
+ordered by (rank, id) and paged with keyset cursors.
+"""
+
+import math
+import re
+from collections import defaultdict
+from threading import Lock
+
+from sqlalchemy import func, or_, tuple_
+from sqlalchemy.types import REAL
+
+from models import (db, User, Message, Follow, TimelineEntry,
+                    MESSAGE_SEARCH_CONFIG, MESSAGE_TSVECTOR)
+from pagination import Page, rank_cursor
+
+USER_FIELD_WEIGHTS = {'username': 1.0, 'bio': 0.5, 'location': 0.5}
+
+
+def is_postgres():
+    """Is the app connected to PostgreSQL?"""
+
+    return db.engine.dialect.name == 'postgresql'
+
+
+def trigrams(text):
+    """Return the set of trigrams of `text`, padded like pg_trgm does."""
+
+    grams = set()
+    for word in text.lower().split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(a_grams, b_grams):
+    """Trigram similarity of two trigram sets (as pg_trgm's similarity())."""
+
+    if not a_grams or not b_grams:
+        return 0.0
+    shared = len(a_grams & b_grams)
+    return shared / (len(a_grams) + len(b_grams) - shared)
+
+
+class TrigramIndex:
+    """In-process trigram index over a few weighted text fields per document.
+
+    Trigrams of the raw (unpadded) text are posted to find candidates that
+    can contain the query as a substring; candidates are then verified and
+    ranked by weighted trigram similarity.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.loaded = False
+        self._docs = {}
+        self._postings = defaultdict(set)
+        self._lock = Lock()
+
+    @staticmethod
+    def _substring_grams(text):
+        text = text.lower()
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, doc_id, **fields):
+        """Index (or re-index) document `doc_id` with the given text fields."""
+
+        with self._lock:
+            self._remove(doc_id)
+            texts = {name: (fields.get(name) or "").lower()
+                     for name in self.weights}
+            self._docs[doc_id] = {
+                name: (text, trigrams(text)) for name, text in texts.items()}
+            for text in texts.values():
+                for gram in self._substring_grams(text):
+                    self._postings[gram].add(doc_id)
+
+    def remove(self, doc_id):
+        """Drop document `doc_id` from the index."""
+
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        fields = self._docs.pop(doc_id, None)
+        if fields is None:
+            return
+        for text, _ in fields.values():
+            for gram in self._substring_grams(text):
+                self._postings[gram].discard(doc_id)
+
+    def search(self, query, limit):
+        """Return up to `limit` doc ids containing `query`, best match first."""
+
+        needle = query.lower()
+        grams = self._substring_grams(needle)
+
+        with self._lock:
+            if grams:
+                candidates = set.intersection(
+                    *(self._postings.get(gram, set()) for gram in grams))
+            else:
+                candidates = set(self._docs)
+
+            query_grams = trigrams(needle)
+            ranked = []
+            for doc_id in candidates:
+                fields = self._docs[doc_id]
+                if not any(needle in text for text, _ in fields.values()):
+                    continue
+                rank = max(
+                    weight * similarity(query_grams, fields[name][1])
+                    for name, weight in self.weights.items()
+                )
+                ranked.append((rank, doc_id))
+
+        ranked.sort(reverse=True)
+        return [doc_id for rank, doc_id in ranked[:limit]]
+
+
+user_index = TrigramIndex(USER_FIELD_WEIGHTS)
+
+
+def index_user(user):
+    """Add or refresh `user` in the in-process index (if it is in use)."""
+
+    if user_index.loaded:
+        user_index.add(
+            user.id,
+            username=user.username,
+            bio=user.bio,
+            location=user.location,
+        )
+
+
+def unindex_user(user_id):
+    """Remove a deleted user from the in-process index."""
+
+    user_index.remove(user_id)
+
+
+def _load_user_index():
+    rows = db.session.execute(
+        db.select(User.id, User.username, User.bio, User.location)
+        .where(User.deleted_at.is_(None)))
+
+    for user_id, username, bio, location in rows:
+        user_index.add(user_id, username=username, bio=bio, location=location)
+
+    user_index.loaded = True
+
+
+def _escape_like(text):
+    return (text
+            .replace("/", "//")
+            .replace("%", "/%")
+            .replace("_", "/_"))
+
+
+def search_users(query, page=1, per_page=50, limit=200):
+    """Return (users, has_next) for page `page` of users matching `query`.
+
+    At most `limit` ranked results are reachable across all pages.
+    """
+
+    start = (page - 1) * per_page
+    stop = min(start + per_page, limit)
+    if start >= stop:
+        return [], False
+
+    if is_postgres():
+        pattern = f"%{_escape_like(query)}%"
+        rank = func.greatest(*(
+            func.similarity(getattr(User, name), query) * weight
+            for name, weight in USER_FIELD_WEIGHTS.items()
+        ))
+
+        users = (User
+                 .query
+                 .filter(or_(*(
+                     getattr(User, name).ilike(pattern, escape="/")
+                     for name in USER_FIELD_WEIGHTS)))
+                 .filter(User.deleted_at.is_(None))
+                 .order_by(rank.desc(), User.id.desc())
+                 .offset(start)
+                 .limit(stop - start + 1)
+                 .all())
+
+    else:
+        if not user_index.loaded:
+            _load_user_index()
+
+        ids = user_index.search(query, stop + 1)[start:]
+        by_id = {user.id: user for user in
+                 User.query
+                 .filter(User.id.in_(ids), User.deleted_at.is_(None))}
+        users = [by_id[user_id] for user_id in ids if user_id in by_id]
+
+    has_next = len(users) > stop - start and stop < limit
+    return users[:stop - start], has_next
+
+
+##############################################################################
+# Message search
+
+WORD_RE = re.compile(r"[a-z0-9']+")
+
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for if in into is it no not of on or such "
+    "that the their then there these they this to was will with".split())
+
+
+def terms(text):
+    """Lowercased, stop-word-free terms of `text`."""
+
+    return [word for word in WORD_RE.findall(text.lower())
+            if word not in STOP_WORDS]
+
+
+class TermIndex:
+    """In-process inverted index from terms to the messages containing them."""
+
+    def __init__(self):
+        self.loaded = False
+        self._postings = defaultdict(dict)
+        self._docs = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, message_id, user_id, text):
+        """Index message `message_id` by `user_id` with body `text`."""
+
+        counts = defaultdict(int)
+        for term in terms(text):
+            counts[term] += 1
+
+        with self._lock:
+            self._docs[message_id] = (user_id, tuple(counts))
+            for term, count in counts.items():
+                self._postings[term][message_id] = count
+
+    def remove(self, message_id):
+        """Drop message `message_id` from the index."""
+
+        with self._lock:
+            self._remove(message_id)
+
+    def remove_user(self, user_id):
+        """Drop every message written by `user_id`."""
+
+        with self._lock:
+            for message_id in [message_id for message_id, (author, _)
+                               in self._docs.items() if author == user_id]:
+                self._remove(message_id)
+
+    def _remove(self, message_id):
+        doc = self._docs.pop(message_id, None)
+        if doc is None:
+            return
+        for term in doc[1]:
+            postings = self._postings[term]
+            postings.pop(message_id, None)
+            if not postings:
+                del self._postings[term]
+
+    def search(self, query, authors=None):
+        """Return [(rank, message_id)] for messages containing every term of
+        `query`, best first; optionally only those by `authors`."""
+
+        query_terms = set(terms(query))
+        if not query_terms:
+            return []
+
+        with self._lock:
+            postings = sorted(
+                (self._postings.get(term, {}) for term in query_terms),
+                key=len)
+            if not postings[0]:
+                return []
+
+            total = len(self._docs)
+            results = []
+            for message_id in postings[0]:
+                if not all(message_id in posting for posting in postings[1:]):
+                    continue
+                if authors is not None and \
+                        self._docs[message_id][0] not in authors:
+                    continue
+                rank = sum(
+                    posting[message_id] * math.log(1 + total / len(posting))
+                    for posting in postings)
+                results.append((rank, message_id))
+
+        results.sort(reverse=True)
+        return results
+
+
+message_index = TermIndex()
+
+
+def index_message(message):
+    """Add a new message to the in-process index (if it is in use)."""
+
+    if message_index.loaded:
+        message_index.add(message.id, message.user_id, message.text)
+
+
+def unindex_message(message_id):
+    """Remove a deleted message from the in-process index."""
+
+    message_index.remove(message_id)
+
+
+def unindex_user_messages(user_id):
+    """Remove every message of a deleted user from the in-process index."""
+
+    message_index.remove_user(user_id)
+
+
+def _load_message_index():
+    rows = db.session.execute(
+        db.select(Message.id, Message.user_id, Message.text)
+        .join(User, User.id == Message.user_id)
+        .where(User.deleted_at.is_(None))
+        .execution_options(yield_per=10_000))
+
+    for message_id, user_id, text in rows:
+        message_index.add(message_id, user_id, text)
+
+    message_index.loaded = True
+
+
+def search_messages(query, before=None, per_page=50, viewer_id=None):
+    """Return a Page of messages matching `query`, best match first.
+
+    `before` is a parsed (rank, id) cursor. With `viewer_id`, only messages
+    on that user's home timeline (their own and those of users they follow)
+    are searched.
+    """
+
+    if is_postgres():
+        tsquery = func.plainto_tsquery(MESSAGE_SEARCH_CONFIG, query)
+        rank = func.ts_rank(MESSAGE_TSVECTOR, tsquery)
+
+        q = (db.session
+             .query(Message, rank)
+             .options(db.joinedload(Message.user))
+             .join(User, User.id == Message.user_id)
+             .filter(MESSAGE_TSVECTOR.bool_op('@@')(tsquery))
+             .filter(User.deleted_at.is_(None)))
+
+        if viewer_id is not None:
+            q = (q.join(TimelineEntry,
+                        TimelineEntry.message_id == Message.id)
+                 .filter(TimelineEntry.user_id == viewer_id))
+
+        if before is not None:
+            q = q.filter(tuple_(rank, Message.id) <
+                         tuple_(db.cast(before[0], REAL), before[1]))
+
+        rows = (q.order_by(rank.desc(), Message.id.desc())
+                .limit(per_page + 1)
+                .all())
+
+        messages = [message for message, _ in rows]
+        ranks = [(float(rank), message.id) for message, rank in rows]
+
+    else:
+        if not message_index.loaded:
+            _load_message_index()
+
+        authors = None
+        if viewer_id is not None:
+            authors = set(db.session.scalars(
+                db.select(Follow.user_being_followed_id)
+                .where(Follow.user_following_id == viewer_id)))
+            authors.add(viewer_id)
+
+        ranks = message_index.search(query, authors)
+        if before is not None:
+            ranks = [key for key in ranks if key < tuple(before)]
+        ranks = ranks[:per_page + 1]
+
+        ids = [message_id for _, message_id in ranks]
+        by_id = {message.id: message for message in
+                 Message.query
+                 .options(db.joinedload(Message.user))
+                 .join(User, User.id == Message.user_id)
+                 .filter(Message.id.in_(ids), User.deleted_at.is_(None))}
+        ranks = [key for key in ranks if key[1] in by_id]
+        messages = [by_id[message_id] for _, message_id in ranks]
+
+    if len(messages) > per_page:
+        return Page(messages[:per_page], rank_cursor(*ranks[per_page - 1]))
+
+    return Page(messages, None)
@@ -1,19 +1,218 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follow
+Streams each CSV in chunks of --chunk-size rows and commits per chunk, so
+memory stays flat however large the files are. On PostgreSQL each chunk is
+loaded with COPY; elsewhere with a batched executemany. Secondary indexes
+(and, on PostgreSQL, foreign keys) are created after the data is in, then
+timelines and counters are rebuilt. Progress is reported in rows/sec.
 
-db.drop_all()
-db.create_all()
+    python seed.py
+    python seed.py --data-dir /data/warbler --chunk-size 200000
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+likes.csv (user_id, message_id, timestamp) is optional.
+"""
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+import argparse
+import csv
+import io
+import sys
+import time
+from datetime import datetime
+from itertools import islice
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follow, DictReader(follows))
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import AddConstraint
 
-db.session.commit()
+from app import app
+from models import db, User, Message, Follow, Like, TimelineEntry
+import counters
+import timelines
+
+# In load order: each file only references tables loaded before it
+FILES = [
+    ('users.csv', User.__table__, True),
+    ('messages.csv', Message.__table__, True),
+    ('follows.csv', Follow.__table__, True),
+    ('likes.csv', Like.__table__, False),
+]
+
+
+def report(label, rows, start):
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {rows:,} rows in {elapsed:.1f}s "
+          f"({rows / max(elapsed, 1e-9):,.0f} rows/s)", file=sys.stderr)
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def converter(column):
+    """Parse a CSV field into the Python type of `column`, for loaders that
+    go through SQLAlchemy's type handling."""
+
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat
+    if python_type is int:
+        return int
+    return None
+
+
+def copy_loader(connection):
+    """Load chunks with COPY over a raw psycopg2 connection."""
+
+    raw = connection.connection.dbapi_connection
+    cursor = raw.cursor()
+    cursor.execute("SET synchronous_commit = off")
+
+    def load(table, columns, rows):
+        buffer = io.StringIO()
+        # Quote everything so empty strings stay '' rather than NULL
+        csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) "
+            f"FROM STDIN WITH (FORMAT csv)",
+            buffer)
+        raw.commit()
+
+    return load
+
+
+def executemany_loader(connection):
+    """Load chunks with a batched INSERT through SQLAlchemy."""
+
+    def load(table, columns, rows):
+        convert = [converter(table.c[name]) for name in columns]
+        connection.execute(table.insert(), [
+            {name: fn(value) if fn else value
+             for name, fn, value in zip(columns, convert, row)}
+            for row in rows
+        ])
+        connection.commit()
+
+    return load
+
+
+def load_csv(load, path, table, chunk_size):
+    """Stream `path` into `table`; return the number of rows loaded."""
+
+    start = time.perf_counter()
+    loaded = 0
+
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        columns = next(reader)
+
+        for chunk in chunks(reader, chunk_size):
+            load(table, columns, chunk)
+            loaded += len(chunk)
+            report(table.name, loaded, start)
+
+    return loaded
+
+
+def drop_deferred(connection, tables):
+    """Drop secondary indexes (and, on PostgreSQL, foreign keys) from
+    `tables`; return what was dropped so it can be recreated."""
+
+    indexes = [index for table in tables for index in table.indexes
+               if not index.unique]
+    for index in indexes:
+        index.drop(connection, checkfirst=True)
+
+    foreign_keys = []
+    if connection.dialect.name == 'postgresql':
+        inspector = inspect(connection)
+        for table in tables:
+            for fk in inspector.get_foreign_keys(table.name):
+                connection.execute(text(
+                    f'ALTER TABLE {table.name} DROP CONSTRAINT "{fk["name"]}"'))
+            foreign_keys.extend(table.foreign_key_constraints)
+
+    connection.commit()
+    return indexes, foreign_keys
+
+
+def create_deferred(connection, indexes, foreign_keys):
+    start = time.perf_counter()
+
+    for index in indexes:
+        index.create(connection, checkfirst=True)
+    for fk in foreign_keys:
+        connection.execute(AddConstraint(fk))
+    connection.commit()
+
+    names = [index.name for index in indexes] + [
+        f"{fk.table.name} -> {fk.referred_table.name}" for fk in foreign_keys]
+    print(f"created {', '.join(names)} in "
+          f"{time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+def seed(data_dir='generator', chunk_size=50_000):
+    start = time.perf_counter()
+
+    db.drop_all()
+    db.create_all()
+
+    with db.engine.connect() as connection:
+        base = [table for _, table, _ in FILES]
+        deferred = drop_deferred(connection, base)
+        timeline_deferred = drop_deferred(
+            connection, [TimelineEntry.__table__])
+
+        if connection.dialect.name == 'postgresql':
+            load = copy_loader(connection)
+        else:
+            load = executemany_loader(connection)
+
+        total = 0
+        for filename, table, required in FILES:
+            path = f"{data_dir}/{filename}"
+            try:
+                total += load_csv(load, path, table, chunk_size)
+            except FileNotFoundError:
+                if required:
+                    raise
+                print(f"{table.name}: skipped, no {path}", file=sys.stderr)
+
+        report("loaded", total, start)
+        create_deferred(connection, *deferred)
+
+    # Timelines are built by one INSERT ... SELECT, so their index is only
+    # created once they are filled
+    step = time.perf_counter()
+    report("timelines", timelines.backfill(), step)
+
+    with db.engine.connect() as connection:
+        create_deferred(connection, *timeline_deferred)
+
+    step = time.perf_counter()
+    counters.reconcile()
+    print(f"counters reconciled in {time.perf_counter() - step:.1f}s",
+          file=sys.stderr)
+
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect() as connection:
+            connection.execute(text("ANALYZE"))
+            connection.commit()
+
+    print(f"seeded in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--data-dir', default='generator')
+    parser.add_argument('--chunk-size', type=int, default=50_000,
+                        help="rows per batch and commit")
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.data_dir, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Streamed page rendering for Warbler's long list pages.
+
+`stream_page` sends a template's output as Jinja generates it, so the nav
+bar and profile header reach the browser while the message list is still
+being rendered, and the worker never holds the whole page in memory.
+Output is coalesced into chunks of about STREAM_CHUNK_SIZE bytes so a page
+isn't written a few bytes at a time.
+
+Headers (and so the session cookie) go out before the first chunk, so
+everything that writes to the session while rendering (the CSRF token,
+popping flashed messages) is done before streaming starts.
+"""
+
+from flask import Response, current_app, get_flashed_messages, stream_template
+
+from forms import csrf_field
+
+
+def _coalesce(chunks, size):
+    buffer = []
+    buffered = 0
+
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_page(template_name, **context):
+    """Return a streamed response rendering `template_name` with `context`."""
+
+    csrf_field()
+    get_flashed_messages(with_categories=True)
+
+    return Response(_coalesce(
+        stream_template(template_name, **context),
+        current_app.config.get('STREAM_CHUNK_SIZE', 8192),
+    ))
@@ -0,0 +1,94 @@
+"""JSON API view tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_api_views.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app, CURR_USER_KEY
+from query_counter import QueryCountMixin
+import purge
+
+# The testing profile reads DATABASE_URL, turns off CSRF and the debug
+# toolbar, and runs background jobs in the request
+app = create_app('testing')
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+
+class ApiViewTestCase(QueryCountMixin, TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u1.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.m1_id = m1.id
+
+        self.client = app.test_client()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_requires_login(self):
+        with self.client as c:
+            resp = c.get("/api/v1/timeline")
+
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(resp.json, {"error": "Access unauthorized."})
+
+    def test_user_messages(self):
+        with self.client as c:
+            self.login(c)
+
+            with self.assertMaxQueries(3):
+                resp = c.get(f"/api/v1/users/{self.u1_id}/messages")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["next_cursor"], None)
+            self.assertEqual(resp.json["items"][0]["text"], "m1-text")
+            self.assertEqual(resp.json["items"][0]["user"]["username"], "u1")
+
+    def test_messages_of_deleted_users_hidden(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        purge.soft_delete(self.u1_id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            resp = c.get(f"/api/v1/messages/{self.m1_id}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_etag_revalidation(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/api/v1/messages/{self.m1_id}")
+            etag = resp.headers["ETag"]
+
+            resp = c.get(f"/api/v1/messages/{self.m1_id}",
+                         headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
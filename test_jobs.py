@@ -0,0 +1,141 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app
+from jobs import handler, job_runner
+
+app = create_app('testing')
+
+app.app_context().push()
+
+db.drop_all()
+db.create_all()
+
+calls = []
+
+
+@handler('test_batch', batch=True)
+def batch_job(payloads):
+    calls.append([payload['n'] for payload in payloads])
+
+
+@handler('test_flaky')
+def flaky_job(n):
+    calls.append(n)
+    if len(calls) < 2:
+        raise ValueError("try again")
+
+
+class JobRunnerTestCase(TestCase):
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+        calls.clear()
+
+        job_runner.mode = 'queue'
+        job_runner.retry_delay = 0
+
+    def tearDown(self):
+        db.session.rollback()
+        job_runner.mode = 'inline'
+
+    def test_idempotency_key(self):
+        """test that a job enqueued twice with the same key runs once"""
+
+        job_runner.enqueue('test_batch', key='once', n=1)
+        job_runner.enqueue('test_batch', key='once', n=1)
+        db.session.commit()
+
+        self.assertEqual(Job.query.count(), 1)
+        self.assertEqual(job_runner.work(once=True), 1)
+        self.assertEqual(calls, [[1]])
+
+    def test_idempotency_key_after_rollback(self):
+        """test that in thread and inline mode a key only counts once its
+        transaction commits, so a rolled-back request can be retried"""
+
+        job_runner.mode = 'inline'
+
+        job_runner.enqueue('test_batch', key='retried', n=1)
+        db.session.rollback()
+
+        job_runner.enqueue('test_batch', key='retried', n=2)
+        job_runner.enqueue('test_batch', key='retried', n=2)
+        db.session.commit()
+
+        job_runner.enqueue('test_batch', key='retried', n=3)
+        db.session.commit()
+
+        self.assertEqual(calls, [[1], [2]])
+
+    def test_run_at(self):
+        """test that a job is held back until its run_at"""
+
+        job_runner.enqueue('test_batch', n=1,
+                           run_at=datetime.utcnow() + timedelta(hours=1))
+        job_runner.enqueue('test_batch', n=2)
+        db.session.commit()
+
+        self.assertEqual(job_runner.work(once=True), 1)
+        self.assertEqual(calls, [[2]])
+
+    def test_batching(self):
+        """test that due jobs of the same kind run in one handler call"""
+
+        for n in range(3):
+            job_runner.enqueue('test_batch', n=n)
+        db.session.commit()
+
+        job_runner.run_pending()
+
+        self.assertEqual(calls, [[0, 1, 2]])
+        self.assertEqual(Job.query.filter_by(status='done').count(), 3)
+
+    def test_retry(self):
+        """test that a failed job is retried and not rolled back into the
+        request"""
+
+        job_runner.enqueue('test_flaky', n=1)
+        db.session.rollback()
+        self.assertEqual(Job.query.count(), 0)
+
+        job_runner.enqueue('test_flaky', n=1)
+        db.session.commit()
+
+        job_runner.run_pending()
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+        self.assertIn("try again", job.last_error)
+
+        job_runner.run_pending()
+        db.session.expire_all()
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('done', 2))
+        self.assertEqual(calls, [1, 1])
+
+    def test_thread_mode(self):
+        """test that thread mode runs jobs after commit, and not at all after
+        a rollback"""
+
+        job_runner.mode = 'thread'
+
+        job_runner.enqueue('test_batch', n=1)
+        db.session.rollback()
+        job_runner.enqueue('test_batch', n=2)
+        db.session.commit()
+        job_runner.join()
+
+        self.assertEqual(calls, [[2]])
+        self.assertEqual(Job.query.count(), 0)
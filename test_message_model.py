@@ -19,11 +19,13 @@ from sqlalchemy.exc import IntegrityError, DataError
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
-# Now we can import app
+# Now we can import app, and build it from the testing profile
 
-from app import app
+from app import create_app
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app = create_app('testing')
+
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
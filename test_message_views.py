@@ -6,9 +6,11 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
+from urllib.parse import quote
 
-from models import db, Message, User
+from models import db, Follow, Like, Message, TrendingScore, User
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,32 +19,40 @@ from models import db, Message, User
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
-# Now we can import app
+# Now we can import app, and build it from the testing profile: that
+# reads DATABASE_URL, turns off CSRF (it's a pain to test) and the debug
+# toolbar, and runs background jobs in the request, so their effects are
+# visible at once
 
-from app import app, CURR_USER_KEY
+from app import create_app, CURR_USER_KEY
+from fragments import fragment_cache
+from trending import trending
+from query_counter import QueryCountMixin
+import purge
+import timelines
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app = create_app('testing')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
 
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class MessageBaseViewTestCase(TestCase):
+class MessageBaseViewTestCase(QueryCountMixin, TestCase):
     def setUp(self):
         User.query.delete()
 
+        # Each test module recreates the tables, so ids repeat; start
+        # without fragments or trending messages cached from rows that are
+        # gone
+        fragment_cache.backend.clear()
+        trending.cache.clear()
+
         u1 = User.signup("u1", "u1@email.com", "password", None)
         db.session.flush()
 
@@ -71,3 +81,438 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertEqual(resp.status_code, 302)
 
             Message.query.filter_by(text="Hello").one()
+
+    def test_show_message_query_count(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            db.session.expire_all()
+
+            with self.assertMaxQueries(3):
+                resp = c.get(f"/messages/{self.m1_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@u1", resp.get_data(as_text=True))
+
+
+class MessageTimelineViewTestCase(MessageBaseViewTestCase):
+    def test_message_fans_out_to_followers(self):
+        """A new message shows up on the home page of the author's followers
+        and disappears once they unfollow."""
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            c.post(f"/users/follow/{self.u1_id}", data={"url": "/"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "fan-out-text"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("fan-out-text", html)
+
+            c.post(f"/users/stop-following/{self.u1_id}", data={"url": "/"})
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn("fan-out-text", html)
+
+
+    def test_follow_jobs_run_in_either_order(self):
+        """Timeline jobs for a follow and an unfollow leave the timeline
+        matching the follows, whichever runs last."""
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        def timeline():
+            return [m.id for m in timelines.read_timeline(u2_id).items]
+
+        # Followed, then unfollowed; the unfollow's job runs first
+        Follow.add_many(u2_id, [self.u1_id])
+        Follow.remove_many(u2_id, [self.u1_id])
+        timelines.remove_follows(u2_id, [self.u1_id])
+        timelines.add_follows(u2_id, [self.u1_id])
+        db.session.commit()
+        self.assertEqual(timeline(), [])
+
+        # Unfollowed, then followed again; the follow's job runs first
+        Follow.add_many(u2_id, [self.u1_id])
+        timelines.add_follows(u2_id, [self.u1_id])
+        timelines.remove_follows(u2_id, [self.u1_id])
+        db.session.commit()
+        self.assertEqual(timeline(), [self.m1_id])
+
+
+class MessageSearchViewTestCase(MessageBaseViewTestCase):
+    def test_search_messages(self):
+        """Searching finds messages containing every query term."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "warbling about birds"})
+
+            resp = c.get("/messages/search", query_string={"q": "birds"})
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("warbling about birds", html)
+            self.assertNotIn("m1-text", html)
+
+            resp = c.get(
+                "/messages/search",
+                query_string={"q": "birds"},
+                headers={"Accept": "application/json"},
+            )
+            self.assertEqual(
+                [m["text"] for m in resp.json["messages"]],
+                ["warbling about birds"])
+
+
+class MessageLikeViewTestCase(MessageBaseViewTestCase):
+    def test_toggle_like(self):
+        """Liking twice toggles the like and keeps the counters in step."""
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            resp = c.post(
+                f"/message/{self.m1_id}/like",
+                data={"url": "/"},
+                headers={"Accept": "application/json"},
+            )
+            self.assertEqual(resp.json, {"liked": True, "likes_count": 1})
+            self.assertEqual(User.query.get(u2_id).likes_count, 1)
+
+            resp = c.post(
+                f"/message/{self.m1_id}/like",
+                data={"url": "/"},
+                headers={"Accept": "application/json"},
+            )
+            self.assertEqual(resp.json, {"liked": False, "likes_count": 0})
+
+            db.session.expire_all()
+            self.assertEqual(User.query.get(u2_id).likes_count, 0)
+
+    def test_like_elsewhere_changes_etag(self):
+        """A like made through another worker, whose cached copy of the
+        viewer is stale here, still changes the page's ETag."""
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            etag = c.get(f"/users/{self.u1_id}").headers["ETag"]
+
+            # No counter bump, so the cached principal stays as it was
+            db.session.add(Like(user_id=u2_id, message_id=self.m1_id))
+            db.session.commit()
+
+            resp = c.get(f"/users/{self.u1_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_cannot_like_own_message(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f"/message/{self.m1_id}/like", data={"url": "/"})
+            self.assertEqual(resp.status_code, 403)
+
+
+class MessageTrendingViewTestCase(MessageBaseViewTestCase):
+    def test_liked_message_trends(self):
+        """A liked message shows up in the trending panel and API."""
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            trending.cache.clear()
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn('id="trending"', html)
+
+            c.post(f"/message/{self.m1_id}/like", data={"url": "/"})
+
+            trending.cache.clear()
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('id="trending"', html)
+            self.assertIn("m1-text", html)
+
+            resp = c.get("/api/v1/trending")
+            self.assertEqual(resp.json["items"][0]["id"], self.m1_id)
+
+
+    def test_unlike_takes_back_its_like(self):
+        """An unlike removes what its like added, however much later it
+        comes, and never takes a score below zero."""
+
+        now = trending.window * 1000 + 60
+        timer = trending.timer
+        trending.timer = lambda: now
+
+        def score():
+            return db.session.scalar(
+                db.select(db.func.sum(TrendingScore.score))
+                .where(TrendingScore.message_id == self.m1_id))
+
+        try:
+            trending.record_like(self.m1_id, True)
+            db.session.commit()
+            self.assertGreater(score(), 0)
+
+            liked_at = datetime.utcfromtimestamp(now)
+            now += trending.half_life / 2
+            trending.record_like(self.m1_id, False, liked_at)
+            db.session.commit()
+            self.assertEqual(score(), 0)
+
+            # A like from before timestamps were kept is taken back at
+            # today's weight, but only down to zero
+            trending.record_like(self.m1_id, False)
+            db.session.commit()
+            self.assertEqual(score(), 0)
+        finally:
+            trending.timer = timer
+
+    def test_liked_messages_in_like_order(self):
+        """The liked-messages page and API list the newest likes first,
+        whenever the messages were posted, and page on the like."""
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        old = Message(text="old-text", user_id=self.u1_id,
+                      timestamp=datetime(2020, 1, 1))
+        db.session.add(old)
+        db.session.flush()
+        db.session.add_all([
+            Like(user_id=u2.id, message_id=self.m1_id,
+                 timestamp=datetime(2021, 1, 1)),
+            Like(user_id=u2.id, message_id=old.id,
+                 timestamp=datetime(2022, 1, 1)),
+        ])
+        db.session.commit()
+        u2_id, old_id = u2.id, old.id
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u2_id
+
+                cursor = f"2022-01-01T00:00:00,{old_id}"
+
+                html = c.get(f"/users/{u2_id}/liked_messages").get_data(
+                    as_text=True)
+                self.assertIn("old-text", html)
+                self.assertNotIn("m1-text", html)
+                self.assertIn(f"?before={quote(cursor, safe='')}", html)
+
+                html = c.get(f"/users/{u2_id}/liked_messages",
+                             query_string={"before": cursor}).get_data(
+                                 as_text=True)
+                self.assertIn("m1-text", html)
+                self.assertNotIn("old-text", html)
+
+                resp = c.get(f"/api/v1/users/{u2_id}/likes")
+                self.assertEqual(
+                    [m["id"] for m in resp.json["items"]], [old_id])
+                self.assertEqual(resp.json["next_cursor"], cursor)
+
+                resp = c.get(f"/api/v1/users/{u2_id}/likes",
+                             query_string={"before": cursor})
+                self.assertEqual(
+                    [m["id"] for m in resp.json["items"]], [self.m1_id])
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+
+class MessageFragmentCacheTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        timelines.fan_out_message(Message.query.get(self.m1_id))
+        db.session.commit()
+
+    def test_timeline_reuses_rendered_messages(self):
+        fragment_cache.backend.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+            misses = fragment_cache.misses
+
+            resp = c.get("/")
+            self.assertIn("m1-text", resp.get_data(as_text=True))
+            self.assertEqual(fragment_cache.misses, misses)
+
+    def test_profile_edit_rerenders_messages(self):
+        fragment_cache.backend.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+            c.post("/users/profile", data={
+                "username": "renamed",
+                "email": "u1@email.com",
+                "password": "password",
+            })
+
+            resp = c.get("/")
+            self.assertIn("@renamed", resp.get_data(as_text=True))
+
+    def test_counter_changes_keep_rendered_messages(self):
+        """Likes and follows bump the author's version, but not what their
+        messages show, so the fragments stay cached."""
+
+        fragment_cache.backend.clear()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+            misses = fragment_cache.misses
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            c.post(f"/users/follow/{self.u1_id}", data={"url": "/"})
+            c.post(f"/message/{self.m1_id}/like", data={"url": "/"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+            self.assertIn("m1-text", resp.get_data(as_text=True))
+            self.assertEqual(fragment_cache.misses, misses)
+
+
+class MessageDeletedAuthorTestCase(MessageBaseViewTestCase):
+    """Messages of a soft-deleted user disappear before the purge runs."""
+
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u2_id = u2.id
+
+    def delete_author(self):
+        purge.soft_delete(self.u1_id)
+        db.session.commit()
+
+    def test_show_message(self):
+        self.delete_author()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_like(self):
+        self.delete_author()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f"/message/{self.m1_id}/like", data={"url": "/"})
+            self.assertEqual(resp.status_code, 404)
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+
+    def test_timeline(self):
+        Follow.add_many(self.u2_id, [self.u1_id])
+        timelines.add_follows(self.u2_id, [self.u1_id])
+        db.session.commit()
+        self.assertEqual(
+            [m.id for m in timelines.read_timeline(self.u2_id).items],
+            [self.m1_id])
+
+        self.delete_author()
+
+        self.assertEqual(timelines.read_timeline(self.u2_id).items, [])
+
+    def test_home_without_materialized_timelines(self):
+        Follow.add_many(self.u2_id, [self.u1_id])
+        db.session.commit()
+        self.delete_author()
+
+        app.config['USE_MATERIALIZED_TIMELINES'] = False
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                resp = c.get("/")
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn("m1-text", resp.get_data(as_text=True))
+        finally:
+            app.config['USE_MATERIALIZED_TIMELINES'] = True
+
+    def test_liked_messages(self):
+        db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+        db.session.commit()
+        self.delete_author()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/users/{self.u2_id}/liked_messages")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("m1-text", resp.get_data(as_text=True))
+
+    def test_search(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "warbling about birds"})
+
+            self.delete_author()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get("/messages/search", query_string={"q": "birds"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("warbling about birds",
+                             resp.get_data(as_text=True))
@@ -11,6 +11,7 @@ from sqlalchemy.exc import IntegrityError
 
 
 from models import db, User, Message, Follow
+from passwords import hasher, hash_cost
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,14 +20,18 @@ from models import db, User, Message, Follow
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
-# Now we can import app
+# Now we can import app, and build it from the testing profile
 
-from app import app
+from app import create_app
+
+app = create_app('testing')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 
@@ -115,6 +120,22 @@ class UserModelTestCase(TestCase):
         self.assertEqual(User.authenticate("u1", "blahblah"), False)
         self.assertEqual(User.authenticate("wrongusername", "password"), False)
 
+    def test_authenticate_rehashes_on_cost_change(self):
+        """test that a successful login rehashes a password stored with a
+        different bcrypt cost"""
+
+        rounds = hasher.rounds
+        hasher.rounds = 4
+
+        try:
+            u1 = User.authenticate("u1", "password")
+            db.session.commit()
+
+            self.assertEqual(hash_cost(u1.password), 4)
+            self.assertEqual(User.authenticate("u1", "password"), u1)
+        finally:
+            hasher.rounds = rounds
+
     def test_not_valid_img_URL(self):
         """test invalid img URL"""
 
@@ -6,28 +6,47 @@
 
 
 import os
+import re
+import time
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, Message, User
-
-from app import app, CURR_USER_KEY
+from models import db, Follow, Job, Message, User
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+from app import create_app, CURR_USER_KEY
+from fragments import fragment_cache
+from graph import graph_index
+from jobs import job_runner
+from passwords import hasher
+from principal import user_cache
+from query_counter import QueryCountMixin
+from recommendations import recommender
+from throttle import login_throttle, MemoryBackend
+import counters
+import follows
+import forms
+import purge
+
+# The testing profile turns off CSRF and the debug toolbar, and runs
+# background jobs in the request, so their effects are visible at once
+app = create_app('testing')
+
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
 
-app.config['WTF_CSRF_ENABLED'] = False
-
 
-class UserBaseViewTestCase(TestCase):
+class UserBaseViewTestCase(QueryCountMixin, TestCase):
     def setUp(self):
         User.query.delete()
 
+        # Each test module recreates the tables, so ids repeat; start
+        # without fragments rendered for rows that are gone
+        fragment_cache.backend.clear()
+
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
         m1 = Message(text="m1-text", user_id=u1.id)
@@ -123,3 +142,459 @@ class UserBaseViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             html = resp.get_data(as_text=True)
             self.assertIn("Access unauthorized.", html)
+
+    def test_profile_pagination(self):
+        """test that a profile page only shows messages older than the
+        `before` cursor and links to the next page"""
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "newer text"})
+
+            resp = c.get(f"/users/{self.u1_id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("newer text", html)
+            self.assertNotIn("m1-text", html)
+            self.assertIn("?before=", html)
+
+            newer = Message.query.filter_by(text="newer text").one()
+            cursor = f"{newer.timestamp.isoformat()},{newer.id}"
+
+            resp = c.get(f"/users/{self.u1_id}", query_string={"before": cursor})
+            html = resp.get_data(as_text=True)
+            self.assertIn("m1-text", html)
+            self.assertNotIn("newer text", html)
+
+        app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_follow_updates_counters(self):
+        """test that following and unfollowing keep both users' counters in
+        step with the follows table"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}", data={"url": "/"})
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 1)
+            self.assertEqual(u2.followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.u2_id}", data={"url": "/"})
+
+            db.session.expire_all()
+            self.assertEqual(u1.following_count, 0)
+            self.assertEqual(u2.followers_count, 0)
+
+    def test_home_query_count(self):
+        """test that the home page issues a fixed number of queries no matter
+        how many authors appear on the timeline"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/users/follow/{self.u1_id}", data={"url": "/"})
+            for i in range(5):
+                c.post("/messages/new", data={"text": f"u2 text {i}"})
+
+            db.session.expire_all()
+
+            with self.assertMaxQueries(4):
+                resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            html = resp.get_data(as_text=True)
+            self.assertIn("@u1", html)
+            self.assertIn("@u2", html)
+
+    def test_profile_edit_refreshes_cached_user(self):
+        """test that editing a profile invalidates the cached session user"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+
+            c.post("/users/profile", data={
+                "username": "u1-renamed",
+                "email": "u1@email.com",
+                "password": "password",
+            })
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("@u1-renamed", html)
+
+    def test_user_search(self):
+        """test that searching users matches usernames and ranks the closest
+        match first"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users", query_string={"q": "u2"})
+            html = resp.get_data(as_text=True)
+            self.assertIn("@u2", html)
+            self.assertNotIn("@u1<", html)
+
+            resp = c.get("/users", query_string={"q": "nobody-here"})
+            self.assertIn("Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_user_search_hides_deleted_users(self):
+        """test that a deleted account drops out of user search at once"""
+
+        purge.soft_delete(self.u2_id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users", query_string={"q": "u2"})
+            self.assertNotIn("@u2", resp.get_data(as_text=True))
+
+    def test_login_throttled_after_failures(self):
+        """test that repeated failed logins for a username are rejected with
+        a 429 before the password is checked"""
+
+        backend = login_throttle.backend
+        login_throttle.backend = MemoryBackend()
+
+        try:
+            with self.client as c:
+                for i in range(app.config['LOGIN_MAX_FAILURES_PER_USERNAME']):
+                    resp = c.post("/login", data={
+                        "username": "u1", "password": "wrong-password"})
+                    self.assertEqual(resp.status_code, 200)
+
+                resp = c.post("/login", data={
+                    "username": "u1", "password": "password"})
+                self.assertEqual(resp.status_code, 429)
+
+                resp = c.post("/login", data={
+                    "username": "u2", "password": "password"})
+                self.assertEqual(resp.status_code, 302)
+        finally:
+            login_throttle.backend = backend
+
+    def test_login_busy_when_hashing_queue_full(self):
+        """test that a login is answered with a 503 while the password
+        hashing queue is full, and that the rejection is counted and
+        logged"""
+
+        for _ in range(hasher.max_pending):
+            hasher._pending.acquire()
+        rejected = hasher.stats()['rejected']
+        stats_interval = hasher.stats_interval
+        hasher.stats_interval = 1e-9
+
+        try:
+            with self.client as c, self.assertLogs('passwords', 'INFO') as logs:
+                resp = c.post("/login", data={
+                    "username": "u1", "password": "password"})
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers["Retry-After"], "1")
+            self.assertEqual(hasher.stats()['rejected'], rejected + 1)
+            self.assertIn(f"{rejected + 1} rejected", "\n".join(logs.output))
+        finally:
+            hasher.stats_interval = stats_interval
+            for _ in range(hasher.max_pending):
+                hasher._pending.release()
+
+    def test_bulk_follow_is_idempotent(self):
+        """test that bulk follow only reports users whose follow state
+        changed and that unfollowing twice is harmless"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post("/users/follow/bulk",
+                          json={"user_ids": [self.u2_id, self.u1_id]})
+            self.assertEqual(resp.json, {"changed": [self.u2_id]})
+
+            resp = c.post("/users/follow/bulk", json={"user_ids": [self.u2_id]})
+            self.assertEqual(resp.json, {"changed": []})
+
+            resp = c.post(f"/users/stop-following/{self.u2_id}",
+                          data={"url": "/"})
+            self.assertEqual(resp.status_code, 302)
+            resp = c.post(f"/users/stop-following/{self.u2_id}",
+                          data={"url": "/"})
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+
+    def test_bulk_follow_skips_deleted_users(self):
+        """test that bulk follow neither follows a deleted user nor bumps
+        their counters"""
+
+        purge.soft_delete(self.u2_id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post("/users/follow/bulk", json={"user_ids": [self.u2_id]})
+            self.assertEqual(resp.json, {"changed": []})
+
+        db.session.expire_all()
+        self.assertEqual(Follow.query.count(), 0)
+        self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+    def test_profile_is_streamed(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/users/{self.u1_id}")
+
+            self.assertTrue(resp.is_streamed)
+            self.assertIn("m1-text", resp.get_data(as_text=True))
+
+    def test_profile_conditional_get(self):
+        """test that a repeat profile load with a current ETag gets a 304,
+        and that following the user changes the ETag"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u2_id}")
+            etag = resp.headers["ETag"]
+            self.assertIn("private", resp.headers["Cache-Control"])
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post(f"/users/follow/{self.u2_id}", data={"url": "/"})
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_csrf_token_only_for_pages_with_forms(self):
+        """test that a GET page without forms generates no CSRF token, and
+        that all the forms on a page share a single token"""
+
+        with self.client as c:
+            resp = c.get("/")
+            self.assertNotIn("csrf_token", resp.get_data(as_text=True))
+            with c.session_transaction() as sess:
+                self.assertNotIn("csrf_token", sess)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u2_id}")
+            tokens = re.findall(
+                r'name="csrf_token" type="hidden" value="([^"]*)"',
+                resp.get_data(as_text=True))
+            self.assertGreater(len(tokens), 1)
+            self.assertEqual(len(set(tokens)), 1)
+
+    def test_csrf_overhead_per_request(self):
+        """micro-benchmark: CSRF work is at most one token per request, however
+        many forms the page has, and a small share of the request; pages
+        without forms and POSTs that redirect generate none"""
+
+        db.session.add_all([Message(text=f"msg-{i}", user_id=self.u1_id)
+                            for i in range(50)])
+        db.session.commit()
+
+        timings = []
+        generate_csrf = forms.generate_csrf
+
+        def timed_generate_csrf():
+            start = time.perf_counter()
+            try:
+                return generate_csrf()
+            finally:
+                timings.append(time.perf_counter() - start)
+
+        def measure(request, n=20):
+            """Return (tokens per request, seconds generating them per
+            request, seconds per request, last response)."""
+
+            timings.clear()
+            start = time.perf_counter()
+            for _ in range(n):
+                resp = request()
+                # Streamed pages render as the body is read
+                resp.get_data()
+            elapsed = time.perf_counter() - start
+            return len(timings) / n, sum(timings) / n, elapsed / n, resp
+
+        forms.generate_csrf = timed_generate_csrf
+        try:
+            with self.client as c:
+                tokens, _, _, resp = measure(lambda: c.get("/"))
+                self.assertEqual(tokens, 0)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                tokens, csrf_seconds, seconds, resp = measure(
+                    lambda: c.get(f"/users/{self.u1_id}"))
+                self.assertGreater(
+                    resp.get_data(as_text=True).count('name="csrf_token"'), 50)
+                self.assertEqual(tokens, 1)
+                self.assertLess(csrf_seconds, seconds / 10)
+
+                tokens, _, _, resp = measure(lambda: c.get("/"))
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(tokens, 1)
+
+                tokens, _, _, resp = measure(
+                    lambda: c.post("/messages/new", data={"text": "hi"}))
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(tokens, 0)
+        finally:
+            forms.generate_csrf = generate_csrf
+
+    def test_delete_user_hides_then_purges(self):
+        """test that deleting an account hides it at once and the purge
+        removes its rows and fixes the other users' counters"""
+
+        app.config['PURGE_BATCH_SIZE'] = 1
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}", data={"url": "/"})
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertEqual(resp.status_code, 404)
+
+        db.session.expire_all()
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(), 0)
+        self.assertEqual(Follow.query.count(), 0)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+    def test_home_suggests_friends_of_friends(self):
+        """test that the home page suggests users followed by the people the
+        user follows, until the user follows them"""
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        u3_id = u3.id
+
+        follows.follow(self.u1_id, [self.u2_id])
+        follows.follow(self.u2_id, [u3_id])
+        db.session.commit()
+
+        recommender.recompute()
+        db.session.commit()
+        user_cache.invalidate(self.u1_id)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('id="suggestions"', html)
+            self.assertIn(f'action="/users/follow/{u3_id}"', html)
+
+            c.post(f"/users/follow/{u3_id}", data={"url": "/"})
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn('id="suggestions"', html)
+
+    def test_follow_changes_schedule_recommendations(self):
+        """test that follows and unfollows schedule one recompute, due at the
+        end of the period, which picks up the period's last change, and
+        that inline jobs schedule none"""
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        u3_id = u3.id
+
+        follows.follow(self.u2_id, [u3_id])
+        db.session.commit()
+        self.assertEqual(Job.query.count(), 0)
+
+        # A period that has already ended, so its job is due
+        refresh = recommender.refresh
+        start = (int(time.time() // refresh) - 1) * refresh
+        timer = recommender.timer
+        recommender.timer = lambda: start + 1
+        job_runner.mode = 'queue'
+
+        try:
+            follows.follow(self.u1_id, [self.u2_id])
+            db.session.commit()
+            follows.unfollow(self.u1_id, [self.u2_id])
+            db.session.commit()
+            follows.follow(self.u1_id, [self.u2_id])
+            db.session.commit()
+
+            job = Job.query.filter_by(kind='recompute_recommendations').one()
+            self.assertEqual(job.run_at,
+                             datetime.utcfromtimestamp(start + refresh))
+
+            job_runner.run_pending()
+            db.session.expire_all()
+            self.assertEqual(User.query.get(self.u1_id).recommended_ids,
+                             [u3_id])
+        finally:
+            recommender.timer = timer
+            job_runner.mode = 'inline'
+            Job.query.delete()
+            db.session.commit()
+
+    def test_graph_index_follow_state(self):
+        """test that with the follow graph index on, follow buttons reflect
+        follows made in this process and, via graph_version, elsewhere"""
+
+        graph_index.enabled = True
+        graph_index.build()
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post(f"/users/follow/{self.u2_id}", data={"url": "/"})
+                self.assertTrue(
+                    graph_index.is_following(self.u1_id, self.u2_id))
+                self.assertEqual(graph_index.follower_count(self.u2_id), 1)
+
+                html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+                self.assertIn("Unfollow", html)
+
+                # As another worker would: the index only sees the new
+                # graph_version
+                Follow.remove_many(self.u1_id, [self.u2_id])
+                counters.adjust_many([self.u1_id, self.u2_id],
+                                     graph_version=1)
+                db.session.commit()
+                user_cache.invalidate(self.u1_id, self.u2_id)
+
+                html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+                self.assertNotIn("Unfollow", html)
+                self.assertEqual(graph_index.following(self.u1_id).tolist(),
+                                 [])
+                self.assertEqual(graph_index.follower_count(self.u2_id), 0)
+        finally:
+            graph_index.enabled = False
@@ -0,0 +1,110 @@
+"""Login throttling for Warbler.
+
+Failed logins are counted per username and per client IP over a sliding
+window. Once either count reaches its limit, further attempts are rejected
+before any password hashing is done, so credential-stuffing traffic can't
+burn bcrypt CPU.
+
+Counts live in a backend; `MemoryBackend` keeps them in-process. Anything
+with the same `add`/`count`/`clear` methods (e.g. a shared store) can be
+plugged in instead.
+"""
+
+import time
+from collections import OrderedDict, deque
+from threading import Lock
+
+
+class MemoryBackend:
+    """In-process sliding-window event log, bounded to `max_keys` keys."""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._events = OrderedDict()
+        self._lock = Lock()
+
+    def add(self, key, now):
+        """Record an event for `key` at time `now`."""
+
+        with self._lock:
+            events = self._events.get(key)
+            if events is None:
+                events = self._events[key] = deque()
+            self._events.move_to_end(key)
+            events.append(now)
+
+            while len(self._events) > self.max_keys:
+                self._events.popitem(last=False)
+
+    def count(self, key, since):
+        """Number of events for `key` at or after `since`."""
+
+        with self._lock:
+            events = self._events.get(key)
+            if not events:
+                return 0
+
+            while events and events[0] < since:
+                events.popleft()
+            if not events:
+                del self._events[key]
+                return 0
+
+            return len(events)
+
+    def clear(self, key):
+        """Forget every event for `key`."""
+
+        with self._lock:
+            self._events.pop(key, None)
+
+
+class LoginThrottle:
+    """Sliding-window limits on failed logins per username and per IP."""
+
+    def __init__(self, backend=None, max_per_username=5, max_per_ip=50,
+                 window=300, timer=time.monotonic):
+        self.backend = backend or MemoryBackend()
+        self.max_per_username = max_per_username
+        self.max_per_ip = max_per_ip
+        self.window = window
+        self.timer = timer
+
+    def init_app(self, app):
+        """Configure limits from `app.config`."""
+
+        self.max_per_username = app.config.setdefault(
+            'LOGIN_MAX_FAILURES_PER_USERNAME', self.max_per_username)
+        self.max_per_ip = app.config.setdefault(
+            'LOGIN_MAX_FAILURES_PER_IP', self.max_per_ip)
+        self.window = app.config.setdefault(
+            'LOGIN_THROTTLE_WINDOW', self.window)
+
+    @staticmethod
+    def _keys(username, ip):
+        return f"user:{username.lower()}", f"ip:{ip}"
+
+    def allowed(self, username, ip):
+        """May a login for `username` from `ip` be attempted now?"""
+
+        user_key, ip_key = self._keys(username, ip)
+        since = self.timer() - self.window
+
+        return (self.backend.count(user_key, since) < self.max_per_username
+                and self.backend.count(ip_key, since) < self.max_per_ip)
+
+    def record_failure(self, username, ip):
+        """Count a failed login for `username` from `ip`."""
+
+        now = self.timer()
+        for key in self._keys(username, ip):
+            self.backend.add(key, now)
+
+    def reset(self, username):
+        """Clear the failures for `username` after a successful login."""
+
+        user_key, _ = self._keys(username, "")
+        self.backend.clear(user_key)
+
+
+login_throttle = LoginThrottle()
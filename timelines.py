@@ -0,0 +1,143 @@
+"""Fan-out-on-write home timelines for Warbler.
+
+Every message is copied into the `timelines` table for its author when it is
+posted, and for each of the author's followers by a background job. Follow
+changes add or remove the followed user's messages from the follower's
+timeline, also in the background (see jobs.py). Rows are inserted skipping
+ones that exist, so the jobs can overlap or be retried, and the follow jobs
+check `follows` as it is when they run, so they can run out of order.
+Reading a home page is then a range scan on (user_id, timestamp) instead of
+an IN-query over every followed user's messages.
+"""
+
+from sqlalchemy import delete, insert, literal, select
+
+from jobs import handler, job_runner
+from models import (db, insert_ignore, Follow, Message, TimelineEntry,
+                    User)
+from pagination import keyset_page, message_cursor
+
+TIMELINE_COLUMNS = ['user_id', 'message_id', 'timestamp']
+
+
+def fan_out_message(message):
+    """Add `message` to its author's timeline, and enqueue adding it to the
+    timelines of all their followers. The caller commits."""
+
+    db.session.execute(
+        insert(TimelineEntry).values(
+            user_id=message.user_id,
+            message_id=message.id,
+            timestamp=message.timestamp,
+        )
+    )
+
+    job_runner.enqueue('fan_out_to_followers',
+                       key=f'fan-out:{message.id}', message_id=message.id)
+
+
+@handler('fan_out_to_followers', batch=True)
+def fan_out_to_followers(payloads):
+    """Add messages to the timelines of their authors' followers."""
+
+    followers = (
+        select(Follow.user_following_id, Message.id, Message.timestamp)
+        .join(Follow, Follow.user_being_followed_id == Message.user_id)
+        .where(Message.id.in_(
+            [payload['message_id'] for payload in payloads]))
+        .where(Follow.user_following_id != Message.user_id)
+    )
+    db.session.execute(
+        insert_ignore(TimelineEntry).from_select(TIMELINE_COLUMNS, followers))
+
+
+def remove_message(message_id):
+    """Remove a message from every timeline it was fanned out to."""
+
+    db.session.execute(
+        delete(TimelineEntry).where(TimelineEntry.message_id == message_id))
+
+
+@handler('add_follows')
+def add_follows(follower_id, followed_ids):
+    """Copy the messages of those of `followed_ids` that `follower_id` still
+    follows into their timeline.
+
+    Jobs can run out of order (retries, several workers), so both follow
+    handlers act on the follows as they are when they run, not as they were
+    when enqueued.
+    """
+
+    messages = (
+        select(literal(follower_id), Message.id, Message.timestamp)
+        .join(Follow, Follow.user_being_followed_id == Message.user_id)
+        .where(Follow.user_following_id == follower_id)
+        .where(Message.user_id.in_(followed_ids))
+    )
+    db.session.execute(
+        insert_ignore(TimelineEntry).from_select(TIMELINE_COLUMNS, messages))
+
+
+@handler('remove_follows')
+def remove_follows(follower_id, followed_ids):
+    """Drop the messages of those of `followed_ids` that `follower_id` no
+    longer follows from their timeline."""
+
+    followed = (
+        select(Follow.user_being_followed_id)
+        .where(Follow.user_following_id == follower_id)
+    )
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.user_id == follower_id)
+        .where(TimelineEntry.message_id.in_(
+            select(Message.id)
+            .where(Message.user_id.in_(followed_ids))
+            .where(Message.user_id.not_in(followed))))
+    )
+
+
+def read_timeline(user_id, before=None, per_page=100):
+    """Return a page of messages on the home timeline of `user_id`, newest
+    first, starting after the parsed cursor `before`."""
+
+    query = (Message
+             .query
+             .options(db.joinedload(Message.user))
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .join(User, User.id == Message.user_id)
+             .filter(TimelineEntry.user_id == user_id)
+             .filter(User.deleted_at.is_(None)))
+
+    return keyset_page(
+        query,
+        (TimelineEntry.timestamp, TimelineEntry.message_id),
+        before,
+        per_page,
+        message_cursor,
+    )
+
+
+def backfill():
+    """Rebuild every timeline from the `messages` and `follows` tables.
+
+    Returns the number of timeline rows written.
+    """
+
+    db.session.execute(delete(TimelineEntry))
+
+    own = select(Message.user_id, Message.id, Message.timestamp)
+    db.session.execute(
+        insert(TimelineEntry).from_select(TIMELINE_COLUMNS, own))
+
+    followed = (
+        select(Follow.user_following_id, Message.id, Message.timestamp)
+        .join(Message, Message.user_id == Follow.user_being_followed_id)
+        .where(Follow.user_following_id != Follow.user_being_followed_id)
+    )
+    db.session.execute(
+        insert(TimelineEntry).from_select(TIMELINE_COLUMNS, followed))
+
+    db.session.commit()
+
+    return TimelineEntry.query.count()
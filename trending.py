@@ -0,0 +1,208 @@
+"""Trending messages for Warbler.
+
+Ranking messages by recent likes with a GROUP BY over `likes` would scan
+every like on every request. Instead, each like (and each new message, with
+a smaller weight) adds to the message's score in the `trending_scores` row
+for the current window of TRENDING_WINDOW seconds. An unlike takes back
+what its like added, from the window the like landed in (see below), never
+taking a score under zero.
+
+Scores decay with a half-life of TRENDING_HALF_LIFE seconds. Rather than
+decaying every stored score as time passes, a like is weighted up by how far
+into its window it came (2 ** (seconds since window start / half-life)), so
+within a window, stored scores already rank correctly, and the top of each
+window is an index scan. Only the last TRENDING_WINDOWS windows count: the
+top TRENDING_SIZE of each is read, decayed to now, merged and cut back to
+TRENDING_SIZE with a heap; messages scoring under TRENDING_MIN_SCORE (by
+default, a fresh post nobody has liked yet) are left out. The result is
+cached for TRENDING_CACHE_TTL seconds, so pages showing trending messages
+cost O(K) and rarely touch the database.
+
+When a new window starts, a 'compact_trending' job deletes the windows that
+have aged out (see jobs.py); `flask compact-trending` does the same.
+"""
+
+import heapq
+import time
+from collections import defaultdict, namedtuple
+from datetime import timezone
+
+from sqlalchemy import case, delete, or_, select, union_all, update
+
+from cache import TTLCache
+from jobs import handler, job_runner
+from models import db, upsert, Message, TrendingScore, User
+
+TRENDING_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.likes_count,
+    Message.user_id,
+    User.username,
+    User.image_url,
+)
+
+TrendingMessage = namedtuple(
+    'TrendingMessage', [column.key for column in TRENDING_COLUMNS])
+
+
+class TrendingBoard:
+    """Keeps trending scores and serves the current top messages."""
+
+    def __init__(self, window=86400, windows=2, half_life=21600, size=50,
+                 post_weight=0.5, min_score=0.75, cache_ttl=30,
+                 timer=time.time):
+        self.window = window
+        self.windows = windows
+        self.half_life = half_life
+        self.size = size
+        self.post_weight = post_weight
+        self.min_score = min_score
+        self.timer = timer
+        self.cache = TTLCache(maxsize=1, ttl=cache_ttl)
+        self._compacted_bucket = None
+
+    def init_app(self, app):
+        """Configure from `app.config`."""
+
+        self.window = app.config.setdefault('TRENDING_WINDOW', 86400)
+        self.windows = app.config.setdefault('TRENDING_WINDOWS', 2)
+        self.half_life = app.config.setdefault('TRENDING_HALF_LIFE', 21600)
+        self.size = app.config.setdefault('TRENDING_SIZE', 50)
+        self.post_weight = app.config.setdefault('TRENDING_POST_WEIGHT', 0.5)
+        self.min_score = app.config.setdefault('TRENDING_MIN_SCORE', 0.75)
+        self.cache = TTLCache(
+            maxsize=1, ttl=app.config.setdefault('TRENDING_CACHE_TTL', 30))
+        self._compacted_bucket = None
+
+    def _bucket(self, now):
+        return int(now // self.window)
+
+    def _score(self, when, weight):
+        """Return the window of time `when` and what `weight` counts for
+        there."""
+
+        bucket = self._bucket(when)
+        return bucket, weight * 2 ** (
+            (when - bucket * self.window) / self.half_life)
+
+    def _add(self, message_id, weight):
+        bucket, score = self._score(self.timer(), weight)
+
+        insert = upsert(TrendingScore).values(
+            bucket=bucket, message_id=message_id, score=score)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=['bucket', 'message_id'],
+            set_={'score': TrendingScore.score + insert.excluded.score},
+        ))
+
+        if bucket != self._compacted_bucket:
+            self._compacted_bucket = bucket
+            job_runner.enqueue('compact_trending',
+                               key=f'compact-trending:{bucket}')
+
+    def _take_back(self, message_id, when):
+        bucket, score = self._score(when, 1)
+
+        db.session.execute(
+            update(TrendingScore)
+            .where(TrendingScore.bucket == bucket)
+            .where(TrendingScore.message_id == message_id)
+            .values(score=case(
+                (TrendingScore.score > score, TrendingScore.score - score),
+                else_=0,
+            ))
+        )
+
+    def record_like(self, message_id, liked, liked_at=None):
+        """Count a like of `message_id` now or, with `liked` False, take back
+        the like made at `liked_at` (a naive UTC datetime; None means now).
+        The caller commits."""
+
+        if liked:
+            self._add(message_id, 1)
+        elif liked_at is None:
+            self._take_back(message_id, self.timer())
+        else:
+            self._take_back(
+                message_id, liked_at.replace(tzinfo=timezone.utc).timestamp())
+
+    def record_message(self, message):
+        """Give a newly posted message its starting score. The caller
+        commits."""
+
+        if self.post_weight:
+            self._add(message.id, self.post_weight)
+
+    def _ranked(self):
+        now = self.timer()
+        current = self._bucket(now)
+
+        # One statement: the top of each live window, with its messages
+        windows = union_all(*(
+            select(
+                select(TrendingScore.bucket, TrendingScore.message_id,
+                       TrendingScore.score)
+                .where(TrendingScore.bucket == bucket)
+                .order_by(TrendingScore.score.desc())
+                .limit(self.size)
+                .subquery()
+            )
+            for bucket in range(current - self.windows + 1, current + 1)
+        )).subquery()
+
+        rows = db.session.execute(
+            select(windows.c.bucket, windows.c.score, *TRENDING_COLUMNS)
+            .join(Message, Message.id == windows.c.message_id)
+            .join(User, User.id == Message.user_id)
+            .where(User.deleted_at.is_(None))
+        )
+
+        scores = defaultdict(float)
+        messages = {}
+        for bucket, score, *message in rows:
+            decay = 2 ** (-(now - bucket * self.window) / self.half_life)
+            scores[message[0]] += score * decay
+            messages[message[0]] = message
+
+        return [
+            (TrendingMessage(*messages[message_id]), score)
+            for score, message_id in heapq.nlargest(
+                self.size,
+                ((score, message_id) for message_id, score in scores.items()
+                 if score >= self.min_score))
+        ]
+
+    def top(self, limit=None):
+        """Return up to `limit` (at most TRENDING_SIZE) trending messages as
+        (TRENDING_COLUMNS row, score) pairs, best first."""
+
+        top = self.cache.get('top')
+        if top is None:
+            top = self._ranked()
+            self.cache.set('top', top)
+
+        return top[:limit]
+
+    def compact(self):
+        """Delete windows that no longer count, and rows that have dropped
+        to zero. Returns the number of rows deleted."""
+
+        oldest = self._bucket(self.timer()) - self.windows + 1
+        deleted = db.session.execute(
+            delete(TrendingScore).where(or_(
+                TrendingScore.bucket < oldest,
+                TrendingScore.score <= 0,
+            ))
+        ).rowcount
+        self.cache.clear()
+        return deleted
+
+
+trending = TrendingBoard()
+
+
+@handler('compact_trending')
+def compact_trending():
+    trending.compact()